@@ -1,5 +1,6 @@
 import enum
 import json
+import os
 import pathlib
 import typing
 
@@ -9,6 +10,13 @@ class TeamColor(enum.Enum):
     BLUE = 2
 
 
+class ColorSpace(enum.Enum):
+    # Convert frames to HSV and threshold them with inRange
+    HSV = 1
+    # Mask BGR frames directly through a lookup table built from the HSV ranges
+    BGR_LUT = 2
+
+
 class AppContextUpdate(typing.NamedTuple):
     key: str
     value: typing.Any
@@ -49,11 +57,52 @@ class ValueContext:
         }
 
 
+def check_range(key: str, value, context: dict):
+    """
+    :param context: The ValueContext JSON the value is advertised with
+
+    :return: The value, if it is within the context's bounds
+    """
+
+    value_min, value_max = context["value_min"], context["value_max"]
+    if (value_min is not None and value < value_min) or (value_max is not None and value > value_max):
+        raise ValueError(f"{key} must be between {value_min} and {value_max}, got {value}")
+    return value
+
+
 class HSVColor:
     h: int
     s: int
     v: int
 
+    # Static metadata for the UI, built once instead of on every to_json
+    H_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="H",
+        value_min=0,
+        value_max=180,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    S_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="S",
+        value_min=0,
+        value_max=255,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    V_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="V",
+        value_min=0,
+        value_max=255,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
     def __init__(self, h: int, s: int, v: int):
         self.h = int(h)
         self.s = int(s)
@@ -63,36 +112,15 @@ class HSVColor:
         return {
             "h": {
                 "value": self.h,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="H",
-                    value_min=0,
-                    value_max=180,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HSVColor.H_CONTEXT,
             },
             "s": {
                 "value": self.s,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="S",
-                    value_min=0,
-                    value_max=255,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HSVColor.S_CONTEXT,
             },
             "v": {
                 "value": self.v,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="V",
-                    value_min=0,
-                    value_max=255,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HSVColor.V_CONTEXT,
             },
         }
 
@@ -163,11 +191,36 @@ class ColorContext:
 
     team: TeamColor
 
+    # Bumped by every update, so filters compiled from the colors know when
+    # they are out of date
+    version: int
+
+    TEAM_CONTEXT = ValueContext(
+        type="ENUM",
+        name="Team",
+        value_min=None,
+        value_max=None,
+        allowed_values=[team.name for team in TeamColor],
+        value_step=None,
+    ).to_json()
+
+    # Filters color_filter compiles from the colors and caches on the
+    # context. They are rebuilt rather than copied or pickled, the lookup
+    # table alone is 256 KiB.
+    DERIVED_ATTRIBUTES = ("_color_filter", "_bgr_color_filter")
+
     def __init__(self, red1: HSVColorRange, red2: HSVColorRange, blue: HSVColorRange, team: TeamColor):
         self.red1 = red1
         self.red2 = red2
         self.blue = blue
         self.team = team
+        self.version = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ColorContext.DERIVED_ATTRIBUTES:
+            state.pop(name, None)
+        return state
 
     def to_json(self):
         return {
@@ -176,14 +229,7 @@ class ColorContext:
             "blue": self.blue.to_json(),
             "team": {
                 "value": self.team.name,
-                "context": ValueContext(
-                    type="ENUM",
-                    name="Team",
-                    value_min=None,
-                    value_max=None,
-                    allowed_values=[team.name for team in TeamColor],
-                    value_step=None,
-                ).to_json(),
+                "context": ColorContext.TEAM_CONTEXT,
             },
         }
 
@@ -203,6 +249,7 @@ class ColorContext:
             self.team = TeamColor[update.value]
         else:
             raise ValueError(f"Unknown key {update.key}")
+        self.version += 1
 
     @staticmethod
     def from_json(json_dict: dict):
@@ -231,6 +278,51 @@ class HoughCircleContext:
     circle_filter_b: float
     circle_filter_m: int
 
+    DP_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="dp",
+        value_min=1,
+        value_max=2,
+        allowed_values=None,
+        value_step=0.1,
+    ).to_json()
+
+    PARAM1_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="param1",
+        value_min=0,
+        value_max=300,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    PARAM2_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="param2",
+        value_min=0,
+        value_max=255,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    CIRCLE_FILTER_B_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="circle_filter_b",
+        value_min=0,
+        value_max=50,
+        allowed_values=None,
+        value_step=0.25,
+    ).to_json()
+
+    CIRCLE_FILTER_M_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="circle_filter_m",
+        value_min=0,
+        value_max=100,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
     def __init__(self, dp: float, param1: int, param2: int, circle_filter_b: float, circle_filter_m: int):
         self.dp = dp
         self.param1 = int(param1)
@@ -242,58 +334,23 @@ class HoughCircleContext:
         return {
             "dp": {
                 "value": self.dp,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="dp",
-                    value_min=1,
-                    value_max=2,
-                    allowed_values=None,
-                    value_step=0.1,
-                ).to_json(),
+                "context": HoughCircleContext.DP_CONTEXT,
             },
             "param1": {
                 "value": self.param1,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="param1",
-                    value_min=0,
-                    value_max=300,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HoughCircleContext.PARAM1_CONTEXT,
             },
             "param2": {
                 "value": self.param2,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="param2",
-                    value_min=0,
-                    value_max=255,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HoughCircleContext.PARAM2_CONTEXT,
             },
             "circle_filter_b": {
                 "value": self.circle_filter_b,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="circle_filter_b",
-                    value_min=0,
-                    value_max=50,
-                    allowed_values=None,
-                    value_step=0.25,
-                ).to_json(),
+                "context": HoughCircleContext.CIRCLE_FILTER_B_CONTEXT,
             },
             "circle_filter_m": {
                 "value": self.circle_filter_m,
-                "context": ValueContext(
-                    type="NUMBER",
-                    name="circle_filter_m",
-                    value_min=0,
-                    value_max=100,
-                    allowed_values=None,
-                    value_step=1,
-                ).to_json(),
+                "context": HoughCircleContext.CIRCLE_FILTER_M_CONTEXT,
             },
         }
 
@@ -327,18 +384,230 @@ class HoughCircleContext:
         )
 
 
+class PipelineContext:
+    tracking: bool
+    color_space: ColorSpace
+    pyramid: bool
+    pyramid_scale: int
+    hough_roi: bool
+
+    TRACKING_CONTEXT = ValueContext(
+        type="ENUM",
+        name="Tracking window",
+        value_min=None,
+        value_max=None,
+        allowed_values=["OFF", "ON"],
+        value_step=None,
+    ).to_json()
+
+    COLOR_SPACE_CONTEXT = ValueContext(
+        type="ENUM",
+        name="Color space",
+        value_min=None,
+        value_max=None,
+        allowed_values=[color_space.name for color_space in ColorSpace],
+        value_step=None,
+    ).to_json()
+
+    PYRAMID_CONTEXT = ValueContext(
+        type="ENUM",
+        name="Coarse to fine search",
+        value_min=None,
+        value_max=None,
+        allowed_values=["OFF", "ON"],
+        value_step=None,
+    ).to_json()
+
+    PYRAMID_SCALE_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="Coarse downscale",
+        value_min=2,
+        value_max=8,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    HOUGH_ROI_CONTEXT = ValueContext(
+        type="ENUM",
+        name="Hough only around color blobs",
+        value_min=None,
+        value_max=None,
+        allowed_values=["OFF", "ON"],
+        value_step=None,
+    ).to_json()
+
+    def __init__(self, tracking: bool=False, color_space: ColorSpace=ColorSpace.HSV, pyramid: bool=False, pyramid_scale: int=2,
+                    hough_roi: bool=False):
+        self.tracking = bool(tracking)
+        self.color_space = color_space
+        self.pyramid = bool(pyramid)
+        self.pyramid_scale = check_range("pyramid_scale", int(pyramid_scale), PipelineContext.PYRAMID_SCALE_CONTEXT)
+        self.hough_roi = bool(hough_roi)
+
+    def to_json(self):
+        return {
+            "tracking": {
+                "value": "ON" if self.tracking else "OFF",
+                "context": PipelineContext.TRACKING_CONTEXT,
+            },
+            "color_space": {
+                "value": self.color_space.name,
+                "context": PipelineContext.COLOR_SPACE_CONTEXT,
+            },
+            "pyramid": {
+                "value": "ON" if self.pyramid else "OFF",
+                "context": PipelineContext.PYRAMID_CONTEXT,
+            },
+            "pyramid_scale": {
+                "value": self.pyramid_scale,
+                "context": PipelineContext.PYRAMID_SCALE_CONTEXT,
+            },
+            "hough_roi": {
+                "value": "ON" if self.hough_roi else "OFF",
+                "context": PipelineContext.HOUGH_ROI_CONTEXT,
+            },
+        }
+
+    def update(self, update: "AppContextUpdate"):
+        keys = update.key.split(".", 1)
+        key = keys[0]
+        rest = ""
+        if len(keys) > 1:
+            rest = keys[1]
+        if key == "tracking":
+            self.tracking = parse_switch(update.value)
+        elif key == "color_space":
+            self.color_space = ColorSpace[update.value]
+        elif key == "pyramid":
+            self.pyramid = parse_switch(update.value)
+        elif key == "pyramid_scale":
+            self.pyramid_scale = check_range(update.key, int(update.value), PipelineContext.PYRAMID_SCALE_CONTEXT)
+        elif key == "hough_roi":
+            self.hough_roi = parse_switch(update.value)
+        else:
+            raise ValueError(f"Unknown key {update.key}")
+
+    @staticmethod
+    def from_json(json_dict: dict):
+        return PipelineContext(
+            tracking=parse_switch(json_dict["tracking"]["value"]) if "tracking" in json_dict else False,
+            color_space=ColorSpace[json_dict["color_space"]["value"]] if "color_space" in json_dict else ColorSpace.HSV,
+            pyramid=parse_switch(json_dict["pyramid"]["value"]) if "pyramid" in json_dict else False,
+            pyramid_scale=json_dict["pyramid_scale"]["value"] if "pyramid_scale" in json_dict else 2,
+            hough_roi=parse_switch(json_dict["hough_roi"]["value"]) if "hough_roi" in json_dict else False,
+        )
+
+
+class StreamContext:
+    max_fps: float
+    scale: float
+    quality: int
+
+    MAX_FPS_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="Stream frame rate cap",
+        value_min=1,
+        value_max=30,
+        allowed_values=None,
+        value_step=1,
+    ).to_json()
+
+    SCALE_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="Stream scale",
+        value_min=0.25,
+        value_max=1,
+        allowed_values=None,
+        value_step=0.25,
+    ).to_json()
+
+    QUALITY_CONTEXT = ValueContext(
+        type="NUMBER",
+        name="Stream JPEG quality",
+        value_min=10,
+        value_max=100,
+        allowed_values=None,
+        value_step=5,
+    ).to_json()
+
+    def __init__(self, max_fps: float=10, scale: float=1, quality: int=80):
+        self.max_fps = check_range("max_fps", float(max_fps), StreamContext.MAX_FPS_CONTEXT)
+        self.scale = check_range("scale", float(scale), StreamContext.SCALE_CONTEXT)
+        self.quality = check_range("quality", int(quality), StreamContext.QUALITY_CONTEXT)
+
+    def to_json(self):
+        return {
+            "max_fps": {
+                "value": self.max_fps,
+                "context": StreamContext.MAX_FPS_CONTEXT,
+            },
+            "scale": {
+                "value": self.scale,
+                "context": StreamContext.SCALE_CONTEXT,
+            },
+            "quality": {
+                "value": self.quality,
+                "context": StreamContext.QUALITY_CONTEXT,
+            },
+        }
+
+    def update(self, update: "AppContextUpdate"):
+        keys = update.key.split(".", 1)
+        key = keys[0]
+        rest = ""
+        if len(keys) > 1:
+            rest = keys[1]
+        if key == "max_fps":
+            self.max_fps = check_range(update.key, float(update.value), StreamContext.MAX_FPS_CONTEXT)
+        elif key == "scale":
+            self.scale = check_range(update.key, float(update.value), StreamContext.SCALE_CONTEXT)
+        elif key == "quality":
+            self.quality = check_range(update.key, int(update.value), StreamContext.QUALITY_CONTEXT)
+        else:
+            raise ValueError(f"Unknown key {update.key}")
+
+    @staticmethod
+    def from_json(json_dict: dict):
+        return StreamContext(
+            max_fps=json_dict["max_fps"]["value"] if "max_fps" in json_dict else 10,
+            scale=json_dict["scale"]["value"] if "scale" in json_dict else 1,
+            quality=json_dict["quality"]["value"] if "quality" in json_dict else 80,
+        )
+
+
+def parse_switch(value: typing.Any) -> bool:
+    if isinstance(value, str):
+        if value.upper() in ("ON", "TRUE", "1"):
+            return True
+        if value.upper() in ("OFF", "FALSE", "0"):
+            return False
+        raise ValueError(f"Unknown switch value {value}")
+    return bool(value)
+
+
 class AppContext:
     color_context: ColorContext
     circle_context: HoughCircleContext
+    pipeline_context: PipelineContext
+    stream_context: StreamContext
+
+    # Set by config_store.ConfigStore on every snapshot it publishes
+    version: int
 
-    def __init__(self, color_context: ColorContext, circle_context: HoughCircleContext):
+    def __init__(self, color_context: ColorContext, circle_context: HoughCircleContext, pipeline_context: typing.Optional[PipelineContext]=None,
+                    stream_context: typing.Optional[StreamContext]=None):
         self.color_context = color_context
         self.circle_context = circle_context
+        self.pipeline_context = pipeline_context if pipeline_context is not None else PipelineContext()
+        self.stream_context = stream_context if stream_context is not None else StreamContext()
+        self.version = 0
 
     def to_json(self):
         return {
             "color_context": self.color_context.to_json(),
             "circle_context": self.circle_context.to_json(),
+            "pipeline_context": self.pipeline_context.to_json(),
+            "stream_context": self.stream_context.to_json(),
         }
 
     def update(self, update: AppContextUpdate):
@@ -351,6 +620,10 @@ class AppContext:
             self.color_context.update(AppContextUpdate(rest, update.value))
         elif key == "circle_context":
             self.circle_context.update(AppContextUpdate(rest, update.value))
+        elif key == "pipeline_context":
+            self.pipeline_context.update(AppContextUpdate(rest, update.value))
+        elif key == "stream_context":
+            self.stream_context.update(AppContextUpdate(rest, update.value))
         else:
             raise ValueError(f"Unknown key {update.key}")
 
@@ -359,6 +632,8 @@ class AppContext:
         return AppContext(
             color_context=ColorContext.from_json(json_dict["color_context"]),
             circle_context=HoughCircleContext.from_json(json_dict["circle_context"]),
+            pipeline_context=PipelineContext.from_json(json_dict["pipeline_context"]) if "pipeline_context" in json_dict else PipelineContext(),
+            stream_context=StreamContext.from_json(json_dict["stream_context"]) if "stream_context" in json_dict else StreamContext(),
         )
 
 
@@ -367,8 +642,23 @@ def dump_app_context(app_context: AppContext):
 
 
 def save_app_context(file: pathlib.Path, app_context: AppContext):
-    with file.open("w") as f:
+    # Write a temporary file and rename it over the old one, so a crash
+    # mid-write never leaves a half written config behind
+    temporary_file = file.with_name(f".{file.name}.tmp")
+    with temporary_file.open("w") as f:
         json.dump(app_context.to_json(), f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_file, file)
+    # The rename itself is only on disk once the directory is synced
+    try:
+        directory = os.open(file.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
 
 
 def load_app_context(file: pathlib.Path) -> AppContext:
@@ -397,9 +687,33 @@ def get_default_app_context() -> AppContext:
             ),
             team=TeamColor.RED,
         ),
+        pipeline_context = PipelineContext(),
+        stream_context = StreamContext(),
     )
 
 
+def split_app_context_json(json_dict: dict) -> typing.Tuple[dict, dict]:
+    """
+    Splits a to_json tree into the values and the static schema
+
+    :return: Two trees with the same keys as json_dict, one with each
+                setting's value and one with its ValueContext
+    """
+
+    values = {}
+    schema = {}
+    for key, node in json_dict.items():
+        if "value" in node and "context" in node:
+            values[key] = node["value"]
+            schema[key] = node["context"]
+        else:
+            values[key], schema[key] = split_app_context_json(node)
+    return values, schema
+
+
+# The schema never changes, the UI only needs to fetch it once
+APP_CONTEXT_SCHEMA = split_app_context_json(get_default_app_context().to_json())[1]
+
 
 if __name__ == "__main__":
     context = get_default_app_context()
@@ -0,0 +1,245 @@
+import argparse
+import collections
+import json
+import pathlib
+import sys
+import time
+import typing
+
+import cv2
+import numpy
+
+import app_contexts
+import circle_score
+import frame_sources
+import image_finder
+import logger
+import video_stream
+
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """
+    Collects per-stage durations for a run of frames
+    """
+
+    def __init__(self):
+        self.samples: typing.Dict[str, typing.List[float]] = collections.defaultdict(list)
+
+    def time(self, stage: str, function: typing.Callable, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.samples[stage].append(time.perf_counter() - start_time)
+        return result
+
+    def summary(self) -> dict:
+        return {stage: summarize(samples) for stage, samples in self.samples.items()}
+
+
+def summarize(samples: typing.Sequence[float]) -> dict:
+    """
+    :return: Count, mean and percentiles of the samples, in milliseconds
+    """
+
+    milliseconds = numpy.asarray(samples) * 1000
+    summary = {
+        "count": len(samples),
+        "mean_ms": float(milliseconds.mean()) if len(samples) > 0 else 0.0,
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = float(numpy.percentile(milliseconds, percentile)) if len(samples) > 0 else 0.0
+    return summary
+
+
+def load_frames(source: str, frame_count: int, resolution: typing.Tuple[int, int]) -> typing.List[numpy.ndarray]:
+    """
+    Reads frames into memory up front so reading them is not part of the timing
+
+    :return: BGR frames
+    """
+
+    frames = []
+    for image in frame_sources.open_frame_source(source, resolution, realtime=False):
+        frames.append(image.frame)
+        if len(frames) >= frame_count:
+            break
+    if len(frames) == 0:
+        raise ValueError(f"No frames in {source}")
+    return frames
+
+
+def run_stages(frame: numpy.ndarray, app_context: app_contexts.AppContext, timer: StageTimer, detector: str):
+    """
+    Runs the stages of an image_finder detector one at a time
+    """
+
+    pipeline_context = app_context.pipeline_context
+    if detector == "find_image" and pipeline_context.pyramid and pipeline_context.pyramid_scale > 1:
+        run_pyramid_stages(frame, app_context, timer, pipeline_context.pyramid_scale)
+        return
+
+    mask = timer.time("color_filter", image_finder.get_frame_mask, frame, app_context)
+    kernel = numpy.ones((10, 10), numpy.uint8)
+    opening = timer.time("morphology", cv2.morphologyEx, mask, cv2.MORPH_OPEN, kernel)
+    median = timer.time("median_blur", cv2.medianBlur, opening, 5)
+
+    if detector == "find_image":
+        timer.time("find_targets", image_finder.find_targets_in_mask, median)
+        return
+
+    edges = timer.time("canny", cv2.Canny, median, *image_finder.CANNY_THRESHOLDS)
+    circles = timer.time("hough", image_finder.find_hough_circles, edges, median, app_context)
+    if circles is not None:
+        timer.time("circle_score", circle_score.filter_by_composite_score, edges, numpy.around(circles[0]),
+                    app_context.circle_context.circle_filter_b, app_context.circle_context.circle_filter_m)
+
+
+def run_pyramid_stages(frame: numpy.ndarray, app_context: app_contexts.AppContext, timer: StageTimer, scale: int):
+    """
+    Runs the stages of image_finder.find_targets_pyramid one at a time
+    """
+
+    height, width = frame.shape[:2]
+    small = timer.time("downscale", cv2.resize, frame, (width // scale, height // scale), interpolation=cv2.INTER_AREA)
+    mask = timer.time("color_filter", image_finder.get_frame_mask, small, app_context)
+    kernel, median_size = image_finder.get_pyramid_filters(scale)
+    opening = timer.time("morphology", cv2.morphologyEx, mask, cv2.MORPH_OPEN, kernel)
+    if median_size > 1:
+        opening = timer.time("median_blur", cv2.medianBlur, opening, median_size)
+    targets = timer.time("find_targets", image_finder.find_targets_in_mask, opening,
+                            min_area=image_finder.MIN_TARGET_AREA / (scale * scale))
+    for target in targets:
+        timer.time("refine", image_finder.refine_blob, frame, app_context, target.moved(0, 0, scale), image_finder.get_refine_margin(scale))
+
+
+def run_benchmark(frames: typing.Sequence[numpy.ndarray], app_context: app_contexts.AppContext, detector: str="find_image",
+                    repeat: int=1, warmup: int=5) -> dict:
+    """
+    Times every stage of a detector, then the detector as a whole
+
+    :param frames: BGR frames to replay
+    :param app_context: The settings to run with
+    :param detector: The name of the image_finder function to benchmark
+    :param repeat: How many times to replay the frames
+    :param warmup: Frames run before timing starts
+
+    :return: The report, ready to dump as JSON
+    """
+
+    detect = getattr(image_finder, detector)
+    for frame in frames[:warmup]:
+        run_stages(frame, app_context, StageTimer(), detector)
+
+    timer = StageTimer()
+    for _ in range(repeat):
+        for frame in frames:
+            run_stages(frame, app_context, timer, detector)
+
+    end_to_end = []
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            frame_start = time.perf_counter()
+            detect(video_stream.TimedFrame(frame, 0), app_context)
+            end_to_end.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "detector": detector,
+        "color_space": app_context.pipeline_context.color_space.name,
+        "pyramid_scale": app_context.pipeline_context.pyramid_scale if app_context.pipeline_context.pyramid else 1,
+        "hough_roi": app_context.pipeline_context.hough_roi,
+        "frames": len(frames) * repeat,
+        "resolution": [frames[0].shape[1], frames[0].shape[0]],
+        "stages": timer.summary(),
+        "end_to_end": dict(summarize(end_to_end), fps=len(end_to_end) / elapsed if elapsed > 0 else 0.0),
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> typing.List[str]:
+    """
+    :return: A description of every stage whose p50 or p95 latency got worse
+                than the baseline by more than tolerance (0.1 is 10%)
+    """
+
+    regressions = []
+    stages = dict(report["stages"], end_to_end=report["end_to_end"])
+    baseline_stages = dict(baseline.get("stages", {}), end_to_end=baseline.get("end_to_end", {}))
+    for stage, summary in stages.items():
+        if stage not in baseline_stages:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            before = baseline_stages[stage].get(key)
+            after = summary[key]
+            if before and after > before * (1 + tolerance):
+                regressions.append(f"{stage} {key} {before:.3f} -> {after:.3f} ({(after / before - 1) * 100:+.1f}%)")
+
+    before_fps = baseline.get("end_to_end", {}).get("fps")
+    after_fps = report["end_to_end"]["fps"]
+    if before_fps and after_fps < before_fps * (1 - tolerance):
+        regressions.append(f"fps {before_fps:.1f} -> {after_fps:.1f}")
+    return regressions
+
+
+def print_report(report: dict):
+    print(f"{report['detector']} on {report['frames']} frames at {report['resolution'][0]}x{report['resolution'][1]}")
+    print(f"{'stage':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, summary in dict(report["stages"], end_to_end=report["end_to_end"]).items():
+        print(f"{stage:<16}{summary['p50_ms']:>10.3f}{summary['p95_ms']:>10.3f}{summary['p99_ms']:>10.3f}")
+    print(f"{report['end_to_end']['fps']:.1f} frames/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image_finder pipeline stage by stage")
+    parser.add_argument("--source", default="synthetic", help="synthetic, a video file, an image directory or a .npz recording")
+    parser.add_argument("--frames", type=int, default=200, help="Number of frames to load from the source")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to replay the frames")
+    parser.add_argument("--resolution", type=int, nargs=2, default=(320, 240), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--config", type=pathlib.Path, default=pathlib.Path("ballfinder.json"))
+    parser.add_argument("--detector", default="find_image", choices=["find_image", "find_circle_in_image"])
+    parser.add_argument("--color-space", choices=[color_space.name for color_space in app_contexts.ColorSpace],
+                        help="Override the config's color space")
+    parser.add_argument("--pyramid-scale", type=int,
+                        help="Override the config's coarse to fine search, 1 turns it off")
+    parser.add_argument("--hough-roi", choices=["OFF", "ON"],
+                        help="Override whether find_circle_in_image runs Hough only around color blobs")
+    parser.add_argument("--output", type=pathlib.Path, help="Write the report to this JSON file")
+    parser.add_argument("--baseline", type=pathlib.Path, help="Compare against a saved report and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown against the baseline, 0.1 is 10%%")
+    args = parser.parse_args()
+
+    logger.setLevel(logger.INFO)
+
+    app_context = app_contexts.load_app_context(args.config)
+    if args.color_space:
+        app_context.pipeline_context.color_space = app_contexts.ColorSpace[args.color_space]
+    if args.pyramid_scale is not None:
+        app_context.pipeline_context.pyramid = args.pyramid_scale > 1
+        app_context.pipeline_context.pyramid_scale = max(args.pyramid_scale, 2)
+    if args.hough_roi:
+        app_context.pipeline_context.hough_roi = args.hough_roi == "ON"
+    frames = load_frames(args.source, args.frames, tuple(args.resolution))
+    report = run_benchmark(frames, app_context, args.detector, args.repeat)
+    print_report(report)
+
+    if args.output:
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with args.baseline.open("r") as f:
+            baseline = json.load(f)
+        if baseline.get("detector") != report["detector"] or baseline.get("resolution") != report["resolution"]:
+            logger.warning("Baseline was recorded with %s at %s", baseline.get("detector"), baseline.get("resolution"))
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
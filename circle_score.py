@@ -1,5 +1,6 @@
 
 
+import functools
 import math
 import cv2 as cv
 import numpy as np
@@ -37,55 +38,116 @@ def pixelIterate(img, circle, index):
     return (circleScore, circlePoint)
 
 
-def wideCheck(xi, yi, expand, img):
-    for xip in range(xi-expand, xi+expand+1):
-            for yip in range(yi-expand, yi+expand+1):
-                if xip<img.shape[1] and yip < img.shape[0]:
-                    if img[yip, xip]>0:
-                        return True
-    return False
+# Sample angles for the Miroslav perimeter walk. The first angle (0 rad) has
+# always been skipped, so a perfect circle scores 99. math.cos/math.sin are used
+# on purpose so the rounded sample points match the old scalar implementation.
+_MIROSLAV_ANGLES = np.linspace(0, 2*math.pi, endpoint=False, num=100)[1:]
+_MIROSLAV_COS = np.array([math.cos(a) for a in _MIROSLAV_ANGLES])
+_MIROSLAV_SIN = np.array([math.sin(a) for a in _MIROSLAV_ANGLES])
+_MIROSLAV_EXPAND = 3
+
+
+#Build the lookup map used by the Miroslav score, once per frame
+#reach[y + h, x + w] is nonzero when any pixel within `expand` of (x, y) is set.
+#The map covers x in [-w, w + expand) and y in [-h, h + expand) so that it keeps
+#the old window semantics: negative coordinates wrap around like numpy indexing
+#and coordinates past the right/bottom edge count as empty.
+def get_miroslav_reach(img, expand=_MIROSLAV_EXPAND):
+    h = img.shape[0]
+    w = img.shape[1]
+
+    extended = np.zeros((2*h + expand, 2*w + expand), np.uint8)
+    binary = np.greater(img, 0).view(np.uint8)
+    extended[0:h, 0:w] = binary
+    extended[0:h, w:2*w] = binary
+    extended[h:2*h, 0:w] = binary
+    extended[h:2*h, w:2*w] = binary
+
+    kernel = np.ones((2*expand + 1, 2*expand + 1), np.uint8)
+    return cv.dilate(extended, kernel, iterations=1)
 
 
 #Get the Miroslav score for a circle
 #Returns a score for each circle in a range from 0-100
 #Computes how well the pixel circumferences follows the ideal circumference
-def get_miroslav_score(img, circles):
+def get_miroslav_score(img, circles, reach=None):
+    if len(circles) == 0:
+        return np.zeros(0, np.uint8)
+    if reach is None:
+        reach = get_miroslav_reach(img)
 
-    result=np.zeros(len(circles), np.uint8)
-    fi=np.linspace(0,2*math.pi, endpoint=False,  num=100)
-    for c in range(0,len(circles)):
-        sum=0
-        for i in range(1,100):
-            xi=circles[c][0]+round(circles[c][2]*math.cos(fi[i]))
-            yi=circles[c][1]+round(circles[c][2]*math.sin(fi[i]))
+    h = img.shape[0]
+    w = img.shape[1]
+    circles = np.asarray(circles).reshape(-1, 3)
+    radius = circles[:, 2:3]
 
-            sum+=1 if  wideCheck(xi, yi, 3, img) else 0
-        result[c]=sum
-    return result
+    # every perimeter sample of every circle, shape (circles, 99)
+    xs = circles[:, 0:1] + np.round(radius * _MIROSLAV_COS).astype(np.int64) + w
+    ys = circles[:, 1:2] + np.round(radius * _MIROSLAV_SIN).astype(np.int64) + h
 
-#Get the Barish score for a circle
-#Returns scores from 0 - inf
-#computes how well the pixels are close to the circumference
+    inside = (xs >= 0) & (xs < reach.shape[1]) & (ys >= 0) & (ys < reach.shape[0])
+    hits = np.zeros(xs.shape, bool)
+    hits[inside] = reach[ys[inside], xs[inside]] > 0
 
-def get_barish_score(img, circles):
-    circleScores=np.zeros(len(circles), np.uint32)
-    circlePoints=np.zeros(len(circles), np.uint32)
+    return np.count_nonzero(hits, axis=1).astype(np.uint8)
 
-    for i in range(0,len(circles)):
-        ret,thresh1 = cv.threshold(img,5,1,cv.THRESH_BINARY)
-        img_black = np.zeros((img.shape[0],img.shape[1]), np.uint8)
+#Weighted rings used by the Barish score for one radius, centered in a
+#(2*(radius+5)+1) square patch. Pixels closer to the center weigh more.
+#Returns the ring weights and the radius+5 disc used to count edge points.
+@functools.lru_cache(maxsize=256)
+def get_barish_kernels(radius):
+    reach = radius + 5
+    center = (reach, reach)
+
+    weights = np.zeros((2*reach + 1, 2*reach + 1), np.uint8)
+    cv.circle(weights, center, int(3*(radius/4)), int((radius/4)), -1)
+    cv.circle(weights, center, int((radius/2)), int((radius/2)), -1)
+    cv.circle(weights, center, int((radius/4)), int(3*(radius/4)), -1)
 
+    disc = np.zeros((2*reach + 1, 2*reach + 1), np.uint8)
+    cv.circle(disc, center, reach, 1, -1)
 
-        circle=cv.circle(img_black, (circles[i][0], circles[i][1]), int(3*(circles[i][2]/4)),int((circles[i][2]/4)) ,-1)
-        circle=cv.circle(circle, (circles[i][0], circles[i][1]), int((circles[i][2]/2)),int((circles[i][2]/2)) ,-1)
-        circle=cv.circle(circle, (circles[i][0], circles[i][1]),int((circles[i][2]/4)),int(3*(circles[i][2]/4)) ,-1)
+    weights.setflags(write=False)
+    disc.setflags(write=False)
+    return weights, disc
 
-        final_image = np.multiply(thresh1 , circle)
-        circleScores[i] = np.sum(final_image)
 
+#Get the Barish score for a circle
+#Returns scores from 0 - inf
+#computes how well the pixels are close to the circumference
+#The image is thresholded once for all circles and each circle only looks at
+#its own bounding box, using the cached ring kernels for its radius.
+def get_barish_score(img, circles):
+    circleScores=np.zeros(len(circles), np.uint32)
+    circlePoints=np.ones(len(circles), np.uint32)
+    if len(circles) == 0:
+        return np.divide(circleScores, circlePoints)
+
+    h = img.shape[0]
+    w = img.shape[1]
+    ret,thresh1 = cv.threshold(img,5,1,cv.THRESH_BINARY)
 
-        circle_all=cv.circle(img_black, (circles[i][0], circles[i][1]), circles[i][2]+5, 1,-1)
-        points = np.count_nonzero(np.logical_and(thresh1, img_black))
+    for i in range(0,len(circles)):
+        x = int(circles[i][0])
+        y = int(circles[i][1])
+        radius = int(circles[i][2])
+        weights, disc = get_barish_kernels(radius)
+        reach = radius + 5
+
+        # clip the circle's bounding box to the image, and the kernels with it
+        x0 = max(x - reach, 0)
+        y0 = max(y - reach, 0)
+        x1 = min(x + reach + 1, w)
+        y1 = min(y + reach + 1, h)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        roi = thresh1[y0:y1, x0:x1]
+        kx = x0 - (x - reach)
+        ky = y0 - (y - reach)
+        kernel_window = (slice(ky, ky + (y1 - y0)), slice(kx, kx + (x1 - x0)))
+
+        circleScores[i] = np.einsum("ij,ij->", roi, weights[kernel_window], dtype=np.uint32)
+        points = np.einsum("ij,ij->", roi, disc[kernel_window], dtype=np.uint32)
         circlePoints[i]=points if points > 0 else 1
 
 
@@ -0,0 +1,218 @@
+import typing
+
+import cv2
+import numpy
+
+import app_contexts
+import frame_pool
+
+
+class ColorFilter:
+    """
+    A ColorContext compiled into the HSV boxes to pass to cv2.inRange
+
+    Built once per ColorContext version by get_color_filter, so nothing is
+    rebuilt per frame.
+
+    :param boxes: The lower and upper HSV bounds to match
+    :param version: The ColorContext version the filter was built from
+    :param conversion: The cv2.cvtColor code that turns a BGR frame into the
+                        HSV the boxes are in
+    """
+
+    def __init__(self, boxes: typing.Sequence[typing.Tuple[numpy.ndarray, numpy.ndarray]], version: int,
+                    conversion: int=cv2.COLOR_BGR2HSV):
+        self.boxes = list(boxes)
+        self.version = version
+        self.conversion = conversion
+
+    def apply(self, hsv: numpy.ndarray, scratch: typing.Optional[frame_pool.ScratchBuffers]=None) -> numpy.ndarray:
+        """
+        :param hsv: The image converted with self.conversion
+        :param scratch: Buffers to write the mask into instead of allocating
+
+        :return: A mask that is 255 where the image matches any of the boxes
+        """
+
+        shape = hsv.shape[:2]
+        mask = scratch.get("color_mask", shape) if scratch is not None else None
+        if len(self.boxes) == 0:
+            if mask is None:
+                return numpy.zeros(shape, numpy.uint8)
+            mask.fill(0)
+            return mask
+
+        lower, upper = self.boxes[0]
+        mask = cv2.inRange(hsv, lower, upper, dst=mask)
+        for lower, upper in self.boxes[1:]:
+            other = scratch.get("color_mask_other", shape) if scratch is not None else None
+            cv2.bitwise_or(mask, cv2.inRange(hsv, lower, upper, dst=other), dst=mask)
+        return mask
+
+
+def get_color_ranges(color_context: app_contexts.ColorContext) -> typing.List[app_contexts.HSVColorRange]:
+    """
+    :return: The ranges that make up the current team's color
+    """
+
+    if color_context.team == app_contexts.TeamColor.RED:
+        return [color_context.red1, color_context.red2]
+    return [color_context.blue]
+
+
+def _to_box(color_range: app_contexts.HSVColorRange) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    lower = numpy.clip([color_range.lower.h, color_range.lower.s, color_range.lower.v], 0, 255)
+    upper = numpy.clip([color_range.upper.h, color_range.upper.s, color_range.upper.v], 0, 255)
+    return lower.astype(numpy.float64), upper.astype(numpy.float64)
+
+
+def _merge_boxes(boxes: typing.List[typing.Tuple[numpy.ndarray, numpy.ndarray]]) -> typing.List[typing.Tuple[numpy.ndarray, numpy.ndarray]]:
+    # Boxes that can never match cost a full pass for nothing
+    boxes = [(lower, upper) for lower, upper in boxes if numpy.all(lower <= upper)]
+
+    # Two boxes with the same saturation and value bounds whose hue ranges
+    # touch or overlap are really one box, e.g. red1 and red2 when the red
+    # range does not wrap around
+    merged = True
+    while merged:
+        merged = False
+        for first in range(len(boxes)):
+            for second in range(first + 1, len(boxes)):
+                (lower1, upper1), (lower2, upper2) = boxes[first], boxes[second]
+                same_sv = numpy.array_equal(lower1[1:], lower2[1:]) and numpy.array_equal(upper1[1:], upper2[1:])
+                if same_sv and lower2[0] <= upper1[0] + 1 and lower1[0] <= upper2[0] + 1:
+                    boxes[first] = (numpy.minimum(lower1, lower2), numpy.maximum(upper1, upper2))
+                    del boxes[second]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+# 8 bit hue runs from 0 to 179 and wraps around
+HUE_LEVELS = 180
+# Converting with R and B swapped mirrors the hue around green and blue,
+# hue h becomes (HUE_MIRROR - h) % HUE_LEVELS. Red then sits in the middle
+# of the hue range instead of on both ends of it.
+HUE_MIRROR = 120
+
+
+def _mirror_hue(boxes: typing.List[typing.Tuple[numpy.ndarray, numpy.ndarray]]) -> typing.List[typing.Tuple[numpy.ndarray, numpy.ndarray]]:
+    mirrored = []
+    for lower, upper in boxes:
+        low, high = lower[0], min(upper[0], HUE_LEVELS - 1)
+        # Hues up to HUE_MIRROR land at the start of the range, the rest at
+        # the end, so one box can become two
+        for part_low, part_high, offset in ((low, min(high, HUE_MIRROR), HUE_MIRROR),
+                                            (max(low, HUE_MIRROR + 1), high, HUE_MIRROR + HUE_LEVELS)):
+            if part_low <= part_high:
+                mirrored.append((numpy.concatenate([[offset - part_high], lower[1:]]), numpy.concatenate([[offset - part_low], upper[1:]])))
+    return mirrored
+
+
+def compile_color_filter(color_context: app_contexts.ColorContext) -> ColorFilter:
+    boxes = _merge_boxes([_to_box(color_range) for color_range in get_color_ranges(color_context)])
+
+    # Ranges that wrap around the end of the hue, like red1 and red2, only
+    # merge once the hue is mirrored. Filtering the mirrored frame then costs
+    # one inRange, the same as a color that doesn't wrap.
+    mirrored = _merge_boxes(_mirror_hue(boxes))
+    if len(mirrored) < len(boxes):
+        return ColorFilter(mirrored, color_context.version, cv2.COLOR_RGB2HSV)
+    return ColorFilter(boxes, color_context.version)
+
+
+def get_color_filter(color_context: app_contexts.ColorContext) -> ColorFilter:
+    """
+    :return: The compiled filter for the color context, rebuilt only when the
+                context's version changed
+    """
+
+    color_filter = getattr(color_context, "_color_filter", None)
+    if color_filter is None or color_filter.version != color_context.version:
+        color_filter = compile_color_filter(color_context)
+        color_context._color_filter = color_filter # type: ignore
+    return color_filter
+
+
+# Bits kept per BGR channel by the lookup table filter, 6 bits is a 256 KiB
+# table
+BGR_LUT_BITS = 6
+
+
+class BGRColorFilter:
+    """
+    A ColorContext compiled into a mask lookup table over quantized BGR
+
+    Masks camera frames directly, without converting them to HSV first. Every
+    quantized BGR cell is classified once, through the HSV filter, when the
+    table is built.
+    """
+
+    def __init__(self, table: numpy.ndarray, bits: int, version: int):
+        self.table = table
+        self.bits = bits
+        self.version = version
+
+        # Maps each channel straight to its part of the table index
+        codes = numpy.arange(256, dtype=numpy.uint16 if 3 * bits <= 16 else numpy.int32) >> (8 - bits)
+        self.channel_codes = numpy.stack([codes << (2 * bits), codes << bits, codes], axis=-1).reshape(1, 256, 3)
+
+    def apply(self, bgr: numpy.ndarray, scratch: typing.Optional[frame_pool.ScratchBuffers]=None) -> numpy.ndarray:
+        """
+        :param bgr: The BGR image
+        :param scratch: Buffers to work in instead of allocating
+
+        :return: A mask that is 255 where the image has the team color
+        """
+
+        shape = bgr.shape[:2]
+        if scratch is None:
+            codes = cv2.LUT(bgr, self.channel_codes)
+            index = numpy.bitwise_or(codes[..., 0], codes[..., 1])
+            numpy.bitwise_or(index, codes[..., 2], out=index)
+            return self.table[index]
+
+        codes = cv2.LUT(bgr, self.channel_codes, dst=scratch.get("lut_codes", shape + (3,), self.channel_codes.dtype))
+        index = numpy.bitwise_or(codes[..., 0], codes[..., 1], out=scratch.get("lut_index", shape, self.channel_codes.dtype))
+        numpy.bitwise_or(index, codes[..., 2], out=index)
+        return numpy.take(self.table, index, out=scratch.get("color_mask", shape))
+
+
+def compile_bgr_color_filter(color_context: app_contexts.ColorContext, bits: int=BGR_LUT_BITS) -> BGRColorFilter:
+    levels = 1 << bits
+    step = 256 >> bits
+    centers = numpy.arange(levels) * step + step // 2
+    blue, green, red = numpy.meshgrid(centers, centers, centers, indexing="ij")
+    cells = numpy.stack([blue, green, red], axis=-1).reshape(-1, 1, 3).astype(numpy.uint8)
+
+    hsv_filter = compile_color_filter(color_context)
+    hsv = cv2.cvtColor(cells, hsv_filter.conversion)
+    table = hsv_filter.apply(hsv).reshape(-1)
+    return BGRColorFilter(table, bits, color_context.version)
+
+
+def get_bgr_color_filter(color_context: app_contexts.ColorContext) -> BGRColorFilter:
+    """
+    :return: The compiled lookup table filter for the color context, rebuilt
+                only when the context's version changed
+    """
+
+    color_filter = getattr(color_context, "_bgr_color_filter", None)
+    if color_filter is None or color_filter.version != color_context.version:
+        color_filter = compile_bgr_color_filter(color_context)
+        color_context._bgr_color_filter = color_filter # type: ignore
+    return color_filter
+
+
+def share_filters(source: app_contexts.ColorContext, target: app_contexts.ColorContext):
+    """
+    Hands the filters compiled for source to a copy of it, for the ones that
+    are still current for the copy's colors
+    """
+
+    for name in app_contexts.ColorContext.DERIVED_ATTRIBUTES:
+        compiled = getattr(source, name, None)
+        if compiled is not None and compiled.version == target.version:
+            setattr(target, name, compiled)
@@ -0,0 +1,136 @@
+import copy
+import pathlib
+import threading
+import time
+import typing
+
+import app_contexts
+import color_filter
+import logger
+
+
+def prepare(app_context: app_contexts.AppContext):
+    """
+    Builds everything derived from a snapshot up front, so the first frame
+    that uses it doesn't pay for it
+    """
+
+    color_filter.get_color_filter(app_context.color_context)
+    if app_context.pipeline_context.color_space == app_contexts.ColorSpace.BGR_LUT:
+        color_filter.get_bgr_color_filter(app_context.color_context)
+
+
+class ConfigStore:
+    """
+    Holds the current AppContext as an immutable snapshot
+
+    Readers call snapshot() once per frame and use that object for the whole
+    frame; it is never modified after it is published. update copies the
+    current snapshot, applies the changes to the copy, builds its derived
+    data and then swaps the reference, so readers never take a lock and
+    never see half an update.
+    """
+
+    def __init__(self, app_context: app_contexts.AppContext):
+        self.version = 0
+        prepare(app_context)
+        app_context.version = self.version
+        self._current = app_context
+        # Only serializes writers
+        self._update_lock = threading.Lock()
+
+    def snapshot(self) -> app_contexts.AppContext:
+        return self._current
+
+    def update(self, updates: typing.Iterable[app_contexts.AppContextUpdate]) -> app_contexts.AppContext:
+        """
+        Applies the updates as one change. If any of them fails the current
+        snapshot stays as it was.
+
+        :return: The new snapshot
+        """
+
+        with self._update_lock:
+            # The compiled filters are left out of the copy, the ones the
+            # updates didn't make stale are shared with it after
+            app_context = copy.deepcopy(self._current)
+            for update in updates:
+                app_context.update(update)
+            color_filter.share_filters(self._current.color_context, app_context.color_context)
+            prepare(app_context)
+            self.version += 1
+            app_context.version = self.version
+            self._current = app_context
+            return app_context
+
+
+class ConfigWriter:
+    """
+    Saves snapshots to the config file from a background thread
+
+    save only records the newest snapshot and returns. The thread writes it
+    once no new snapshot has come in for delay seconds, or at the latest
+    max_delay seconds after the first unsaved one, so dragging a slider
+    costs one write instead of dozens.
+
+    :param file: The config file
+    :param delay: Seconds to wait for more changes before writing
+    :param max_delay: Longest a change waits to be written
+    """
+
+    def __init__(self, file: pathlib.Path, delay: float=0.5, max_delay: float=5.0):
+        self.file = file
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self._pending: typing.Optional[app_contexts.AppContext] = None
+        self._first_change = 0.0
+        self._last_change = 0.0
+        self._condition = threading.Condition()
+        # Serializes writes between the thread and flush
+        self._write_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, app_context: app_contexts.AppContext):
+        with self._condition:
+            now = time.monotonic()
+            if self._pending is None:
+                self._first_change = now
+            self._pending = app_context
+            self._last_change = now
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Writes the pending snapshot now, if there is one
+        """
+
+        with self._write_lock:
+            with self._condition:
+                app_context = self._pending
+                self._pending = None
+            if app_context is not None:
+                self._write(app_context)
+
+    def _write(self, app_context: app_contexts.AppContext):
+        try:
+            app_contexts.save_app_context(self.file, app_context)
+        except Exception:
+            logger.exception("Unable to save %s", self.file)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending is None:
+                        self._condition.wait()
+                        continue
+                    now = time.monotonic()
+                    due = min(self._last_change + self.delay, self._first_change + self.max_delay)
+                    if now >= due:
+                        break
+                    self._condition.wait(due - now)
+            self.flush()
@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+import typing
+from multiprocessing import shared_memory
+
+import numpy
+
+import app_contexts
+import config_store
+import logger
+import metrics
+import video_stream
+
+
+Detector = typing.Callable[[video_stream.TimedFrame, app_contexts.AppContext], typing.Tuple[typing.Any, typing.Optional[video_stream.TimedFrame]]]
+DetectionResult = typing.Tuple[typing.Any, typing.Optional[video_stream.TimedFrame]]
+
+# Same metrics the worker threads in main report
+detection_latency = metrics.histogram("detection_seconds", "Time spent in the detector per frame")
+worker_busy_time = metrics.counter("worker_busy_seconds_total", "Time the workers spent detecting")
+workers_busy = metrics.gauge("workers_busy", "Workers currently detecting")
+
+
+class SharedFrameRing:
+    """
+    A fixed number of frame slots in one block of shared memory
+
+    The parent process owns the ring and hands out free slots. Workers attach
+    to the same block by name and read their frame in place.
+    """
+
+    def __init__(self, slot_count: int, frame_shape: typing.Tuple[int, ...], dtype=numpy.uint8, name: typing.Optional[str]=None):
+        self.slot_count = slot_count
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = numpy.dtype(dtype)
+        self.owner = name is None
+
+        size = slot_count * int(numpy.prod(self.frame_shape)) * self.dtype.itemsize
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        self.slots = numpy.ndarray((slot_count,) + self.frame_shape, dtype=self.dtype, buffer=self.memory.buf)
+
+        self.free_slots = collections.deque(range(slot_count))
+        self.free_slots_lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def write(self, frame: numpy.ndarray) -> typing.Optional[int]:
+        """
+        Copies a frame into a free slot
+
+        :param frame: The frame to copy, must match the ring's frame shape
+
+        :return: The slot index, or None if every slot is in use
+        """
+
+        with self.free_slots_lock:
+            if len(self.free_slots) == 0:
+                return None
+            slot = self.free_slots.popleft()
+        numpy.copyto(self.slots[slot], frame)
+        return slot
+
+    def release(self, slot: int):
+        with self.free_slots_lock:
+            self.free_slots.append(slot)
+
+    def close(self):
+        self.slots = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+# Per worker process state, set up by _init_worker
+_worker_ring: typing.Optional[SharedFrameRing] = None
+# The newest snapshot the worker has seen, with its filters compiled
+_worker_app_context: typing.Optional[app_contexts.AppContext] = None
+
+
+def _init_worker(ring_name: str, slot_count: int, frame_shape: typing.Tuple[int, ...], dtype: str):
+    global _worker_ring
+    _worker_ring = SharedFrameRing(slot_count, frame_shape, dtype, name=ring_name)
+
+
+def _detect_in_worker(detector: Detector, slot: int, timestamp: float, sequence: int, app_context: app_contexts.AppContext):
+    global _worker_app_context
+    assert _worker_ring is not None and _worker_ring.slots is not None
+    frame = _worker_ring.slots[slot]
+    # Snapshots arrive without their compiled filters, so they are built
+    # once per version instead of once per frame
+    if _worker_app_context is None or _worker_app_context.version != app_context.version:
+        config_store.prepare(app_context)
+        _worker_app_context = app_context
+    app_context = _worker_app_context
+    start_time = time.perf_counter()
+    circle, found_frame = detector(video_stream.TimedFrame(frame, timestamp, sequence), app_context)
+    # Only the small detection result goes back to the parent
+    return circle, found_frame is not None, time.perf_counter() - start_time
+
+
+class DetectionPool:
+    """
+    Runs a detector from image_finder in a pool of worker processes
+
+    Frames are copied into a shared memory ring instead of being pickled, so
+    each task only ships a slot index, the frame time and the app context.
+    Results are handed to on_result in the parent along with the frame they
+    are for, as (circle, TimedFrame) tuples, the same shape image_finder
+    returns.
+    """
+
+    def __init__(self, resolution: typing.Tuple[int, int], worker_count: int, detector: Detector,
+                    on_result: typing.Callable[[video_stream.TimedFrame, DetectionResult], None], channels: int=3):
+        self.detector = detector
+        self.on_result = on_result
+        self.frame_shape = (resolution[1], resolution[0], channels)
+        self.dropped_frames = 0
+
+        # Enough slots for every worker plus the frames queued behind them
+        self.ring = SharedFrameRing(worker_count + 4, self.frame_shape)
+
+        # forkserver, since forking a process that already runs the capture
+        # and server threads is not safe
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=worker_count,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_worker,
+            initargs=(self.ring.name, self.ring.slot_count, self.frame_shape, self.ring.dtype.str),
+        )
+
+    def submit(self, image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> bool:
+        """
+        Queues a frame for detection
+
+        :param image_frame: The frame to process
+        :param app_context: The settings to process the frame with
+
+        :return: False if the frame was dropped
+        """
+
+        if image_frame.frame is None or image_frame.frame.shape != self.frame_shape:
+            logger.warning("Dropping frame with shape %s, expected %s", getattr(image_frame.frame, "shape", None), self.frame_shape)
+            self.dropped_frames += 1
+            return False
+
+        slot = self.ring.write(image_frame.frame)
+        if slot is None:
+            self.dropped_frames += 1
+            return False
+
+        workers_busy.inc()
+        future = self.executor.submit(_detect_in_worker, self.detector, slot, image_frame.time, image_frame.sequence, app_context)
+        future.add_done_callback(lambda done: self._finish(done, slot, image_frame))
+        return True
+
+    def _finish(self, future: concurrent.futures.Future, slot: int, image_frame: video_stream.TimedFrame):
+        self.ring.release(slot)
+        workers_busy.dec()
+        try:
+            circle, found_frame, elapsed = future.result()
+        except Exception:
+            logger.exception("Detection worker failed")
+            self.on_result(image_frame, (None, None))
+            return
+        detection_latency.observe(elapsed)
+        worker_busy_time.inc(elapsed)
+        self.on_result(image_frame, (circle, image_frame if found_frame else None))
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.ring.close()
@@ -0,0 +1,278 @@
+import argparse
+import json
+import pathlib
+import time
+import typing
+
+import cv2
+import numpy
+
+import app_contexts
+import benchmark
+import frame_sources
+import image_finder
+import logger
+import tracking
+import video_stream
+
+
+# (x, y, radius)
+Circle = typing.Tuple[float, float, float]
+# Runs a detector on one frame and returns the balls it found, best first
+Detector = typing.Callable[[video_stream.TimedFrame, app_contexts.AppContext], typing.List[Circle]]
+LABELS_FILE = "labels.json"
+
+
+class LabeledFrame(typing.NamedTuple):
+    frame: numpy.ndarray
+    # The balls of the team color in the frame
+    balls: typing.List[Circle]
+
+
+def detect_find_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.List[Circle]:
+    targets, _ = image_finder.find_image(image_frame, app_context)
+    return [(target.x, target.y, target.radius) for target in targets or []]
+
+
+def detect_find_circle_in_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.List[Circle]:
+    circle, _ = image_finder.find_circle_in_image(image_frame, app_context)
+    if circle is None:
+        return []
+    return [(float(circle[0]), float(circle[1]), float(circle[2]))]
+
+
+# Every detector the harness can run, add new ones here
+DETECTORS: typing.Dict[str, Detector] = {
+    "find_image": detect_find_image,
+    "find_circle_in_image": detect_find_circle_in_image,
+}
+
+
+def load_labeled_directory(path: pathlib.Path) -> typing.List[LabeledFrame]:
+    """
+    Loads the frames listed in a directory's labels.json, which looks like
+
+        [{"file": "0001.png", "balls": [{"x": 160, "y": 120, "radius": 20}]}]
+
+    with the balls of the team color in pixels of the image file.
+    """
+
+    with (path / LABELS_FILE).open("r") as f:
+        labels = json.load(f)
+
+    dataset = []
+    for label in labels:
+        frame = cv2.imread(str(path / label["file"]), cv2.IMREAD_COLOR)
+        if frame is None:
+            logger.warning("Skipping unreadable image %s", label["file"])
+            continue
+        balls = [(float(ball["x"]), float(ball["y"]), float(ball["radius"])) for ball in label["balls"]]
+        dataset.append(LabeledFrame(frame, balls))
+    return dataset
+
+
+def load_synthetic(frame_count: int, resolution: typing.Tuple[int, int], team: app_contexts.TeamColor,
+                    ball_count: int=1, seed: int=0) -> typing.List[LabeledFrame]:
+    """
+    Renders frame_sources.SyntheticSource frames along with the balls of the
+    team color drawn in them
+    """
+
+    source = frame_sources.SyntheticSource(resolution, realtime=False, ball_count=ball_count, frame_count=frame_count, seed=seed)
+    return [
+        LabeledFrame(source.render(index), [(ball.x, ball.y, ball.radius) for ball in source.ground_truth(index) if ball.team == team])
+        for index in range(frame_count)
+    ]
+
+
+def match_circles(found: typing.Sequence[Circle], balls: typing.Sequence[Circle], tolerance: float) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Pairs found circles with labeled balls, closest centers first. A pair
+    counts only when the centers are within tolerance * the ball's radius.
+
+    :return: (found index, ball index) pairs
+    """
+
+    candidates = []
+    for found_index, (x, y, _) in enumerate(found):
+        for ball_index, (ball_x, ball_y, ball_radius) in enumerate(balls):
+            distance = numpy.hypot(x - ball_x, y - ball_y)
+            if distance <= tolerance * ball_radius:
+                candidates.append((distance, found_index, ball_index))
+
+    matches = []
+    used_found, used_balls = set(), set()
+    for _, found_index, ball_index in sorted(candidates):
+        if found_index in used_found or ball_index in used_balls:
+            continue
+        used_found.add(found_index)
+        used_balls.add(ball_index)
+        matches.append((found_index, ball_index))
+    return matches
+
+
+class Score:
+    """
+    Tallies how well the circles found in a run of frames match the labels
+
+    :param tolerance: Largest center error that still counts as finding the
+                        ball, as a fraction of its radius
+    """
+
+    def __init__(self, tolerance: float=0.5):
+        self.tolerance = tolerance
+        self.true_positives = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+        self.center_errors: typing.List[float] = []
+        self.radius_errors: typing.List[float] = []
+
+    def add(self, found: typing.Sequence[Circle], balls: typing.Sequence[Circle]):
+        matches = match_circles(found, balls, self.tolerance)
+        self.true_positives += len(matches)
+        self.false_positives += len(found) - len(matches)
+        self.false_negatives += len(balls) - len(matches)
+        for found_index, ball_index in matches:
+            x, y, radius = found[found_index]
+            ball_x, ball_y, ball_radius = balls[ball_index]
+            self.center_errors.append(float(numpy.hypot(x - ball_x, y - ball_y)))
+            self.radius_errors.append(abs(radius - ball_radius))
+
+    @property
+    def precision(self) -> float:
+        found = self.true_positives + self.false_positives
+        return self.true_positives / found if found > 0 else 0.0
+
+    @property
+    def recall(self) -> float:
+        labeled = self.true_positives + self.false_negatives
+        return self.true_positives / labeled if labeled > 0 else 0.0
+
+    @property
+    def f1(self) -> float:
+        precision, recall = self.precision, self.recall
+        return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+    def to_json(self):
+        return {
+            "true_positives": self.true_positives,
+            "false_positives": self.false_positives,
+            "false_negatives": self.false_negatives,
+            "precision": self.precision,
+            "recall": self.recall,
+            "f1": self.f1,
+            "center_error_px": summarize_errors(self.center_errors),
+            "radius_error_px": summarize_errors(self.radius_errors),
+        }
+
+
+def evaluate(dataset: typing.Sequence[LabeledFrame], app_context: app_contexts.AppContext, detector: str="find_image",
+                top: int=0, tolerance: float=0.5, warmup: int=5, framerate: float=30) -> dict:
+    """
+    Runs a detector over a labeled dataset
+
+    :param dataset: The frames with their labels
+    :param app_context: The settings to run with
+    :param detector: The name of a detector in DETECTORS
+    :param top: Only score the first top circles found per frame, 0 scores all
+    :param tolerance: Largest center error that still counts as finding the
+                        ball, as a fraction of its radius
+    :param warmup: Frames run before timing starts
+    :param framerate: Frame times passed to the detector, for tracking
+
+    :return: The accuracy and speed of the detector, ready to dump as JSON
+    """
+
+    detect = DETECTORS[detector]
+    for labeled in dataset[:warmup]:
+        detect(video_stream.TimedFrame(labeled.frame, 0), app_context)
+    # Tracking carries state from frame to frame, every run starts without it
+    image_finder.tracker = tracking.BallTracker()
+
+    score = Score(tolerance)
+    frame_times = []
+    start_time = time.perf_counter()
+    for index, labeled in enumerate(dataset):
+        frame_start = time.perf_counter()
+        found = detect(video_stream.TimedFrame(labeled.frame, index / framerate, index), app_context)
+        frame_times.append(time.perf_counter() - frame_start)
+        score.add(found[:top] if top > 0 else found, labeled.balls)
+    elapsed = time.perf_counter() - start_time
+
+    return dict(
+        {
+            "detector": detector,
+            "color_space": app_context.pipeline_context.color_space.name,
+            "pyramid_scale": app_context.pipeline_context.pyramid_scale if app_context.pipeline_context.pyramid else 1,
+            "tracking": app_context.pipeline_context.tracking,
+            "hough_roi": app_context.pipeline_context.hough_roi,
+            "frames": len(dataset),
+            "frame_time": dict(benchmark.summarize(frame_times), fps=len(frame_times) / elapsed if elapsed > 0 else 0.0),
+        },
+        **score.to_json(),
+    )
+
+
+def summarize_errors(errors: typing.Sequence[float]) -> dict:
+    """
+    :return: Mean and percentiles of errors in pixels
+    """
+
+    summary = {"mean": float(numpy.mean(errors)) if len(errors) > 0 else 0.0}
+    for percentile in benchmark.PERCENTILES:
+        summary[f"p{percentile}"] = float(numpy.percentile(errors, percentile)) if len(errors) > 0 else 0.0
+    return summary
+
+
+def print_results(results: typing.Sequence[dict]):
+    print(f"{'config':<20}{'detector':<24}{'precision':>10}{'recall':>8}{'center px':>10}{'p50 ms':>8}{'fps':>8}")
+    for result in results:
+        print(f"{result['config']:<20}{result['detector']:<24}{result['precision']:>10.3f}{result['recall']:>8.3f}"
+                f"{result['center_error_px']['mean']:>10.2f}{result['frame_time']['p50_ms']:>8.2f}{result['frame_time']['fps']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the accuracy and speed of the image_finder detectors on labeled frames")
+    parser.add_argument("--dataset", default="synthetic", help=f"synthetic, or a directory of images with a {LABELS_FILE}")
+    parser.add_argument("--frames", type=int, default=200, help="Number of synthetic frames")
+    parser.add_argument("--balls", type=int, default=1, help="Synthetic balls of each color")
+    parser.add_argument("--resolution", type=int, nargs=2, default=(320, 240), metavar=("WIDTH", "HEIGHT"),
+                        help="Resolution of synthetic frames")
+    parser.add_argument("--config", type=pathlib.Path, nargs="+", default=[pathlib.Path("ballfinder.json")],
+                        help="Configs to evaluate, each one with every detector")
+    parser.add_argument("--detector", nargs="+", default=list(DETECTORS), choices=list(DETECTORS))
+    parser.add_argument("--top", type=int, default=0, help="Only score the first TOP circles found per frame, 0 scores all")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Largest center error that counts as a hit, as a fraction of the ball's radius")
+    parser.add_argument("--output", type=pathlib.Path, help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    logger.setLevel(logger.INFO)
+
+    results = []
+    dataset_description: dict = {"source": args.dataset}
+    for config in args.config:
+        app_context = app_contexts.load_app_context(config)
+        if args.dataset == "synthetic":
+            dataset = load_synthetic(args.frames, tuple(args.resolution), app_context.color_context.team, args.balls)
+            dataset_description.update(frames=args.frames, balls=args.balls, resolution=list(args.resolution))
+        else:
+            dataset = load_labeled_directory(pathlib.Path(args.dataset))
+            dataset_description.update(frames=len(dataset))
+        if len(dataset) == 0:
+            raise ValueError(f"No frames in {args.dataset}")
+
+        for detector in args.detector:
+            result = evaluate(dataset, app_context, detector, args.top, args.tolerance)
+            result["config"] = config.name
+            results.append(result)
+    print_results(results)
+
+    if args.output:
+        report = {"dataset": dataset_description, "top": args.top, "tolerance": args.tolerance, "results": results}
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import collections
+import threading
+import typing
+
+import numpy
+
+import metrics
+
+
+frame_pool_misses = metrics.counter("frame_pool_misses_total", "Frames that needed a new buffer because the pool was empty")
+
+
+class FramePool:
+    """
+    A fixed set of preallocated frame buffers
+
+    The capture thread acquires a buffer per frame and whoever is last to use
+    the frame releases it: the queue that drops it, or send_results once the
+    frame is no longer the last seen frame. When every buffer is in use a new
+    one is allocated instead of blocking the camera, and counted as a miss.
+    """
+
+    def __init__(self, count: int, shape: typing.Tuple[int, ...], dtype=numpy.uint8):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.buffers = [numpy.empty(self.shape, self.dtype) for _ in range(count)]
+
+        self._free = collections.deque(self.buffers)
+        self._in_use: typing.Set[int] = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: typing.Optional[typing.Tuple[int, ...]]=None) -> numpy.ndarray:
+        """
+        :param shape: The frame shape needed, defaults to the pool's shape
+
+        :return: A buffer owned by the caller until it is released
+        """
+
+        if shape is None or tuple(shape) == self.shape:
+            with self._lock:
+                if len(self._free) > 0:
+                    buffer = self._free.popleft()
+                    self._in_use.add(id(buffer))
+                    return buffer
+        frame_pool_misses.inc()
+        return numpy.empty(shape if shape is not None else self.shape, self.dtype)
+
+    def release(self, buffer: typing.Optional[numpy.ndarray]):
+        """
+        Returns a buffer to the pool. Buffers that did not come from the pool,
+        or were already released, are ignored.
+        """
+
+        if buffer is None:
+            return
+        with self._lock:
+            if id(buffer) in self._in_use:
+                self._in_use.remove(id(buffer))
+                self._free.append(buffer)
+
+    def free_count(self) -> int:
+        with self._lock:
+            return len(self._free)
+
+
+class ScratchBuffers(threading.local):
+    """
+    Per-thread scratch arrays to pass as OpenCV dst= arguments
+
+    Each name keeps one backing buffer that only grows, so frames and windows
+    of varying size reuse it once it is big enough.
+    """
+
+    def __init__(self):
+        self.buffers: typing.Dict[str, numpy.ndarray] = {}
+
+    def get(self, name: str, shape: typing.Tuple[int, ...], dtype=numpy.uint8) -> numpy.ndarray:
+        """
+        :return: A contiguous array of the given shape, reused by later calls
+                    with the same name on this thread
+        """
+
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = numpy.empty(size, dtype)
+            self.buffers[name] = buffer
+        return buffer[:size].reshape(shape)
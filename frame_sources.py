@@ -0,0 +1,322 @@
+import abc
+import itertools
+import math
+import pathlib
+import time
+import typing
+
+import cv2
+import numpy
+
+import app_contexts
+import frame_pool
+import logger
+import recorder
+import video_stream
+
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+class FrameSource(abc.ABC):
+    """
+    Base class for everything that can feed BGR frames into the pipeline
+
+    Iterating a source yields video_stream.TimedFrame objects, the same thing
+    video_stream.get_images yields for the Pi camera. Subclasses only implement
+    read_frames.
+
+    :param resolution: Frames are resized to this (width, height), None keeps
+                        the source size
+    :param framerate: The framerate to pace playback at
+    :param realtime: Sleep between frames to play back at framerate, otherwise
+                        yield frames as fast as they can be read
+    :param loop: Start over when the source runs out of frames
+    :param frame_pool: Copy frames into buffers from this frame_pool.FramePool
+    """
+
+    def __init__(self, resolution: typing.Optional[typing.Tuple[int, int]]=(320, 240), framerate: float=30,
+                    realtime: bool=True, loop: bool=False, frame_pool: typing.Optional[frame_pool.FramePool]=None):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.realtime = realtime
+        self.loop = loop
+        self.frame_pool = frame_pool
+
+    @abc.abstractmethod
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        pass
+
+    def reconfigure(self, resolution: typing.Tuple[int, int], framerate: float,
+                        frame_pool: typing.Optional[frame_pool.FramePool]=None) -> bool:
+        """
+        Changes the resolution and framerate of the frames still to come
+
+        :return: False if the source has to be opened again for the change
+                    to take effect
+        """
+
+        self.resolution = resolution
+        self.framerate = framerate
+        self.frame_pool = frame_pool
+        return True
+
+    def __iter__(self) -> typing.Iterator[video_stream.TimedFrame]:
+        sequence = itertools.count()
+        next_frame_time = time.monotonic()
+
+        while True:
+            frame_count = 0
+            for image in self.read_frames():
+                frame_count += 1
+                period = 1 / self.framerate if self.framerate else 0
+                if self.realtime and period > 0:
+                    delay = next_frame_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                        next_frame_time += period
+                    else:
+                        # Running behind, don't try to catch up with a burst
+                        next_frame_time = time.monotonic() + period
+
+                resize = self.resolution is not None and (image.shape[1], image.shape[0]) != tuple(self.resolution)
+                if self.frame_pool is not None:
+                    size = tuple(self.resolution) if resize else (image.shape[1], image.shape[0])
+                    buffer = self.frame_pool.acquire((size[1], size[0]) + image.shape[2:])
+                    if resize:
+                        cv2.resize(image, size, dst=buffer, interpolation=cv2.INTER_AREA)
+                    else:
+                        numpy.copyto(buffer, image)
+                    image = buffer
+                elif resize:
+                    image = cv2.resize(image, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+
+                yield video_stream.TimedFrame(image, time.monotonic(), next(sequence))
+
+            if not self.loop or frame_count == 0:
+                break
+
+
+class PiCameraSource(FrameSource):
+    """
+    Frames from the Pi camera, paced by the camera itself
+    """
+
+    def __init__(self, resolution: typing.Tuple[int, int]=(320, 240), framerate: float=30,
+                    frame_pool: typing.Optional[frame_pool.FramePool]=None):
+        super().__init__(resolution, framerate, realtime=False, loop=False, frame_pool=frame_pool)
+
+    def reconfigure(self, resolution: typing.Tuple[int, int], framerate: float,
+                        frame_pool: typing.Optional[frame_pool.FramePool]=None) -> bool:
+        # The camera is set up once when it is opened
+        super().reconfigure(resolution, framerate, frame_pool)
+        return False
+
+    def __iter__(self) -> typing.Iterator[video_stream.TimedFrame]:
+        if self.frame_pool is not None:
+            return iter(video_stream.get_pooled_images(self.resolution, self.framerate, self.frame_pool))
+        return iter(video_stream.get_images(self.resolution, self.framerate))
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        # Iterating the source instead keeps the times the camera handed the
+        # frames over
+        for image_frame in self:
+            yield image_frame.frame
+
+
+class VideoFileSource(FrameSource):
+    """
+    Frames from any video file cv2.VideoCapture can open
+    """
+
+    def __init__(self, path: pathlib.Path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = pathlib.Path(path)
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        capture = cv2.VideoCapture(str(self.path))
+        if not capture.isOpened():
+            raise IOError(f"Unable to open video {self.path}")
+        try:
+            while True:
+                ok, image = capture.read()
+                if not ok:
+                    break
+                yield image
+        finally:
+            capture.release()
+
+
+class ImageDirectorySource(FrameSource):
+    """
+    Frames from the image files in a directory, in file name order
+    """
+
+    def __init__(self, path: pathlib.Path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = pathlib.Path(path)
+        self.files = sorted(file for file in self.path.iterdir() if file.suffix.lower() in IMAGE_SUFFIXES)
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        for file in self.files:
+            image = cv2.imread(str(file), cv2.IMREAD_COLOR)
+            if image is None:
+                logger.warning("Skipping unreadable image %s", file)
+                continue
+            yield image
+
+
+class NpzSource(FrameSource):
+    """
+    Frames from a numpy .npz recording with a "frames" array of shape
+    (count, height, width, 3) in BGR order
+    """
+
+    def __init__(self, path: pathlib.Path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = pathlib.Path(path)
+        with numpy.load(self.path) as recording:
+            self.frames = recording["frames"]
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        for image in self.frames:
+            yield image
+
+
+class RecordingSource(FrameSource):
+    """
+    Frames from a directory of recorder.FrameRecorder segment files
+    """
+
+    def __init__(self, path: pathlib.Path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = pathlib.Path(path)
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        for recorded in recorder.read_recording(self.path):
+            yield recorded.frame
+
+
+class SyntheticBall(typing.NamedTuple):
+    x: float
+    y: float
+    radius: float
+    team: app_contexts.TeamColor
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generated frames with red and blue balls bouncing over a noisy background
+
+    Ball positions are a pure function of the frame index, so ground_truth
+    gives the exact balls drawn in any frame.
+
+    :param ball_count: How many balls of each color to draw
+    :param frame_count: Stop after this many frames, None runs forever
+    :param seed: Seed for the background and the ball paths
+    """
+
+    # BGR colors that land inside the default red1 and blue HSV ranges
+    COLORS = {
+        app_contexts.TeamColor.RED: (30, 30, 200),
+        app_contexts.TeamColor.BLUE: (200, 80, 0),
+    }
+
+    def __init__(self, resolution: typing.Tuple[int, int]=(320, 240), framerate: float=30, realtime: bool=True,
+                    ball_count: int=1, frame_count: typing.Optional[int]=None, seed: int=0, loop: bool=False,
+                    frame_pool: typing.Optional[frame_pool.FramePool]=None):
+        super().__init__(resolution, framerate, realtime, loop, frame_pool)
+        self.frame_count = frame_count
+
+        random = numpy.random.default_rng(seed)
+        width, height = resolution
+        self.background = random.integers(40, 90, (height, width, 3), dtype=numpy.uint8)
+
+        self.balls = []
+        for team in (app_contexts.TeamColor.RED, app_contexts.TeamColor.BLUE):
+            for _ in range(ball_count):
+                radius = float(random.uniform(10, min(width, height) / 6))
+                self.balls.append((
+                    team,
+                    radius,
+                    random.uniform(radius, width - radius),
+                    random.uniform(radius, height - radius),
+                    random.uniform(-4, 4),
+                    random.uniform(-4, 4),
+                ))
+
+    @staticmethod
+    def _bounce(start: float, velocity: float, index: int, low: float, high: float) -> float:
+        span = high - low
+        if span <= 0:
+            return low
+        position = math.fmod(start - low + velocity * index, 2 * span)
+        if position < 0:
+            position += 2 * span
+        return low + (position if position <= span else 2 * span - position)
+
+    def ground_truth(self, index: int) -> typing.List[SyntheticBall]:
+        # Balls move over the background, frames are resized from it
+        width, height = self.background.shape[1], self.background.shape[0]
+        return [
+            SyntheticBall(
+                self._bounce(x, vx, index, radius, width - radius),
+                self._bounce(y, vy, index, radius, height - radius),
+                radius,
+                team,
+            )
+            for team, radius, x, y, vx, vy in self.balls
+        ]
+
+    def render(self, index: int) -> numpy.ndarray:
+        image = self.background.copy()
+        for ball in self.ground_truth(index):
+            cv2.circle(image, (round(ball.x), round(ball.y)), round(ball.radius), self.COLORS[ball.team], -1, cv2.LINE_AA)
+        return image
+
+    def read_frames(self) -> typing.Iterator[numpy.ndarray]:
+        indexes = range(self.frame_count) if self.frame_count is not None else itertools.count()
+        for index in indexes:
+            yield self.render(index)
+
+
+def open_frame_source(source: str, resolution: typing.Tuple[int, int]=(320, 240), framerate: float=30,
+                        realtime: bool=True, loop: bool=False,
+                        frame_pool: typing.Optional[frame_pool.FramePool]=None) -> FrameSource:
+    """
+    Opens a frame source from a short description
+
+    :param source: "picamera", "synthetic", a directory of images or of
+                    recorder segments, a .npz recording or a video file
+    :param resolution: The resolution of the frames
+    :param framerate: The framerate of the frames
+    :param realtime: Pace file and synthetic sources at framerate
+    :param loop: Restart file sources when they run out
+    :param frame_pool: Deliver frames in buffers from this pool
+
+    :return: The source, ready to iterate
+    """
+
+    if source == "picamera":
+        return PiCameraSource(resolution, framerate, frame_pool)
+    if source == "synthetic":
+        return SyntheticSource(resolution, framerate, realtime, loop=loop, frame_pool=frame_pool)
+
+    path = pathlib.Path(source)
+    options = dict(resolution=resolution, framerate=framerate, realtime=realtime, loop=loop, frame_pool=frame_pool)
+    if path.is_dir() and len(recorder.list_segments(path)) > 0:
+        return RecordingSource(path, **options)
+    if path.is_dir():
+        return ImageDirectorySource(path, **options)
+    if path.suffix.lower() == ".npz":
+        return NpzSource(path, **options)
+    if path.exists():
+        return VideoFileSource(path, **options)
+    raise ValueError(f"Unknown frame source {source}")
+
+
+if __name__ == "__main__":
+    for image in open_frame_source("synthetic", realtime=False):
+        print(image.time, image.sequence, image.frame.shape)
+        if image.sequence >= 10:
+            break
@@ -0,0 +1,185 @@
+import threading
+import typing
+
+import numpy
+
+import metrics
+
+
+class OperatingPoint(typing.NamedTuple):
+    resolution: typing.Tuple[int, int]
+    framerate: float
+    # Process one frame out of every skip
+    skip: int = 1
+
+    def to_json(self):
+        return {
+            "resolution": list(self.resolution),
+            "framerate": self.framerate,
+            "skip": self.skip,
+            "processed_fps": self.framerate / self.skip,
+        }
+
+
+def parse_resolutions(text: str) -> typing.List[typing.Tuple[int, int]]:
+    """
+    :param text: Comma separated WIDTHxHEIGHT resolutions, e.g.
+                    "320x240,640x480"
+    """
+
+    resolutions = []
+    for resolution in text.split(","):
+        try:
+            width, height = (int(size) for size in resolution.strip().lower().split("x"))
+        except ValueError:
+            raise ValueError(f"Expected a resolution like 320x240, got {resolution!r}") from None
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Expected a positive resolution, got {resolution!r}")
+        resolutions.append((width, height))
+    return resolutions
+
+
+def build_ladder(resolutions: typing.Sequence[typing.Tuple[int, int]], framerate: float=30, max_skip: int=3) -> typing.List[OperatingPoint]:
+    """
+    Builds operating points from cheapest to most expensive: every skip at
+    the lowest resolution, then the higher resolutions
+
+    :param resolutions: The resolutions allowed, smallest first
+    :param framerate: The camera framerate
+    :param max_skip: The most frames to skip at the lowest resolution, at
+                        least 1
+    """
+
+    if len(resolutions) == 0:
+        raise ValueError("The governor needs at least one resolution")
+    max_skip = max(1, max_skip)
+    ladder = [OperatingPoint(tuple(resolutions[0]), framerate, skip) for skip in range(max_skip, 0, -1)]
+    for resolution in resolutions[1:]:
+        ladder.append(OperatingPoint(tuple(resolution), framerate, 2))
+        ladder.append(OperatingPoint(tuple(resolution), framerate, 1))
+    return ladder
+
+
+class Governor:
+    """
+    Moves the pipeline along a ladder of operating points to hold a target
+    latency
+
+    Every interval it looks at the 90th percentile capture to publish latency
+    and the share of frames dropped for busy workers. Over target, or
+    dropping frames, it steps down to a cheaper point right away. Well under
+    target with no drops for several intervals in a row, it steps up.
+
+    :param ladder: Operating points, cheapest first
+    :param start: Index of the point to start at
+    :param target_latency: Seconds from capture to publish to aim for
+    :param interval: Seconds between decisions
+    :param max_drop_rate: Share of captured frames that may be dropped
+    :param headroom: Step up only when latency is under target * headroom
+    :param hold: Good intervals in a row needed before stepping up
+    :param enabled: Stay at the start point when False
+    """
+
+    def __init__(self, ladder: typing.Sequence[OperatingPoint], start: int=0, target_latency: float=0.1, interval: float=1.0,
+                    max_drop_rate: float=0.05, headroom: float=0.6, hold: int=3, enabled: bool=True):
+        if len(ladder) == 0:
+            raise ValueError("The governor needs at least one operating point")
+        self.ladder = list(ladder)
+        self.level = min(max(start, 0), len(self.ladder) - 1)
+        self.target_latency = target_latency
+        self.interval = interval
+        self.max_drop_rate = max_drop_rate
+        self.headroom = headroom
+        self.hold = hold
+        self.enabled = enabled
+
+        self.latencies: typing.List[float] = []
+        self.good_intervals = 0
+        self.last_latency: typing.Optional[float] = None
+        self.last_drop_rate = 0.0
+        self.next_decision: typing.Optional[float] = None
+        self.last_captured = 0.0
+        self.last_dropped = 0.0
+        self.lock = threading.Lock()
+
+        self.level_gauge = metrics.gauge("governor_level", "Index of the governor's operating point, 0 is the cheapest")
+        self.level_gauge.set(self.level)
+
+    @property
+    def operating_point(self) -> OperatingPoint:
+        return self.ladder[self.level]
+
+    def observe(self, latency: float):
+        """
+        Records the capture to publish latency of one result
+        """
+
+        with self.lock:
+            self.latencies.append(latency)
+
+    def update(self, now: float, get_counts: typing.Callable[[], typing.Tuple[float, float]]) -> bool:
+        """
+        Steps the operating point if an interval has passed. Cheap enough to
+        call for every frame.
+
+        :param now: The current time.monotonic() value
+        :param get_counts: Returns the frames captured and the frames dropped
+                            for busy workers so far, only called once an
+                            interval
+
+        :return: True if the operating point changed
+        """
+
+        if self.next_decision is None:
+            self.next_decision = now + self.interval
+            self.last_captured, self.last_dropped = get_counts()
+            return False
+        if now < self.next_decision:
+            return False
+        self.next_decision = now + self.interval
+
+        captured, dropped = get_counts()
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+        new_frames = captured - self.last_captured
+        drop_rate = (dropped - self.last_dropped) / new_frames if new_frames > 0 else 0.0
+        self.last_captured = captured
+        self.last_dropped = dropped
+        self.last_drop_rate = drop_rate
+        if len(latencies) == 0:
+            return False
+        latency = float(numpy.percentile(latencies, 90))
+        self.last_latency = latency
+
+        if not self.enabled:
+            return False
+
+        level = self.level
+        if latency > self.target_latency or drop_rate > self.max_drop_rate:
+            self.good_intervals = 0
+            level = max(level - 1, 0)
+        elif latency < self.target_latency * self.headroom and drop_rate == 0:
+            self.good_intervals += 1
+            if self.good_intervals >= self.hold:
+                self.good_intervals = 0
+                level = min(level + 1, len(self.ladder) - 1)
+        else:
+            self.good_intervals = 0
+
+        if level == self.level:
+            return False
+        self.level = level
+        self.level_gauge.set(level)
+        return True
+
+    def to_json(self):
+        return {
+            "enabled": self.enabled,
+            "level": self.level,
+            "operating_point": self.operating_point.to_json(),
+            "ladder": [point.to_json() for point in self.ladder],
+            "target_latency": self.target_latency,
+            "latency_p90": self.last_latency,
+            "drop_rate": self.last_drop_rate,
+        }
@@ -1,3 +1,4 @@
+import math
 import time
 import typing
 
@@ -6,72 +7,159 @@ import numpy
 
 import app_contexts
 import circle_score
+import color_filter
+import frame_pool
 import logger
+import metrics
+import tracking
 import video_stream
 
 
-def get_color_filter_mask(frame: numpy.ndarray, current_color_context: app_contexts.ColorContext):
-    hsv = frame
+# Shared by every worker thread, see tracking.BallTracker
+tracker = tracking.BallTracker()
+tracking_window_hits = metrics.counter("tracking_window_hits_total", "Frames where the ball was found inside the tracking window")
+tracking_window_misses = metrics.counter("tracking_window_misses_total", "Frames that fell back to a full frame search after a tracking window miss")
+# Per worker thread dst= buffers, so the filters don't allocate every frame
+scratch = frame_pool.ScratchBuffers()
+opening_kernel = numpy.ones((10, 10), numpy.uint8)
 
-    mask=None
-    if current_color_context.team == app_contexts.TeamColor.RED:
-        upper_red2 = numpy.array([current_color_context.red2.upper.h, current_color_context.red2.upper.s, current_color_context.red2.upper.v])
-        lower_red2 = numpy.array([current_color_context.red2.lower.h, current_color_context.red2.lower.s, current_color_context.red2.lower.v])
-        mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
 
-        upper_red1 = numpy.array([current_color_context.red1.upper.h, current_color_context.red1.upper.s, current_color_context.red1.upper.v])
-        lower_red1 = numpy.array([current_color_context.red1.lower.h, current_color_context.red1.lower.s, current_color_context.red1.lower.v])
-        mask1 = cv2.inRange(hsv, lower_red1, upper_red1)
+def get_frame_mask(frame: numpy.ndarray, app_context: app_contexts.AppContext) -> numpy.ndarray:
+    """
+    Masks a BGR camera frame with the team color
 
-        mask = mask1 | mask2 # type: ignore
-    else:
-        upper_blue = numpy.array([current_color_context.blue.upper.h, current_color_context.blue.upper.s, current_color_context.blue.upper.v])
-        lower_blue = numpy.array([current_color_context.blue.lower.h, current_color_context.blue.lower.s, current_color_context.blue.lower.v])
+    :param frame: The BGR image, or a region of it
+    :param app_context: The colors and the color space to filter in
 
-        mask = cv2.inRange(hsv, lower_blue, upper_blue)
-    return mask
+    :return: A mask that is 255 where the frame has the team color
+    """
 
-def find_circle_in_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.Tuple[typing.Optional[numpy.ndarray], typing.Optional[video_stream.TimedFrame]]:
-    try:
-        start_time = time.time()
-        if image_frame.frame is None:
-            return None, image_frame
+    if app_context.pipeline_context.color_space == app_contexts.ColorSpace.BGR_LUT:
+        return color_filter.get_bgr_color_filter(app_context.color_context).apply(frame, scratch)
+    hsv_filter = color_filter.get_color_filter(app_context.color_context)
+    hsv = cv2.cvtColor(frame, hsv_filter.conversion, dst=scratch.get("hsv", frame.shape))
+    return hsv_filter.apply(hsv, scratch)
 
-        mask = get_color_filter_mask(image_frame.frame, app_context.color_context)
-        logger.debug("color filter time %d", time.time()-start_time)
-        start_time = time.time()
-        kernel = numpy.ones((10, 10), numpy.uint8)
+# Padding around a blob's bounding box for the Hough search, as a fraction
+# of the box's larger side
+HOUGH_ROI_PADDING = 0.25
 
-        opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
 
-        median = cv2.medianBlur(opening,5)
-        logger.debug("filters time %d", time.time()-start_time)
-        start_time = time.time()
-        edges = cv2.Canny(median, 100, 200)
+def get_blob_radius_bounds(rect: typing.Tuple[int, int, int, int]) -> typing.Tuple[int, int]:
+    """
+    :param rect: A blob's bounding box
 
-        bigcircle=None
-        circles = cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT,
+    :return: The smallest and largest radius of a ball that would make a blob
+                that size, within the 10 to 200 of the full frame search
+    """
+
+    _, _, w, h = rect
+    half_size = max(w, h) / 2
+    return max(10, int(half_size * 0.6)), min(200, int(math.ceil(half_size * 1.25)) + 1)
+
+
+def find_circles_in_blobs(edges: numpy.ndarray, mask: numpy.ndarray, app_context: app_contexts.AppContext) -> typing.Optional[numpy.ndarray]:
+    """
+    Runs Hough on each color blob's padded bounding box instead of the whole
+    edge image, looking only for radii that fit the blob
+
+    :param edges: The edges of the cleaned up mask
+    :param mask: The cleaned up color mask
+    :param app_context: The Hough settings
+
+    :return: The circles in frame coordinates, shaped like the result of
+                cv2.HoughCircles, or None if there are none
+    """
+
+    height, width = edges.shape[:2]
+    found = []
+    for blob in find_targets_in_mask(mask):
+        x, y, w, h = blob.rect
+        min_radius, max_radius = get_blob_radius_bounds(blob.rect)
+        if max_radius < min_radius:
+            continue
+        padding = int(HOUGH_ROI_PADDING * max(w, h)) + 2
+        x0, y0 = max(x - padding, 0), max(y - padding, 0)
+        x1, y1 = min(x + w + padding, width), min(y + h + padding, height)
+        circles = cv2.HoughCircles(edges[y0:y1, x0:x1], cv2.HOUGH_GRADIENT,
                                     dp=app_context.circle_context.dp, minDist=100,
                                     param1=app_context.circle_context.param1,
                                     param2=app_context.circle_context.param2,
-                                    minRadius=10,maxRadius=200)
-        logger.debug("hough time %d", time.time()-start_time)
-        start_time = time.time()
-
+                                    minRadius=min_radius, maxRadius=max_radius)
         if circles is not None:
-            circles = circle_score.filter_by_composite_score(edges, numpy.around(circles[0]), app_context.circle_context.circle_filter_b, app_context.circle_context.circle_filter_m)
-            logger.debug("circle filter time %d", time.time()-start_time)
-            start_time = time.time()
-            circles = numpy.uint16(numpy.around(circles))
-            counter=0
-            big=0
-            for circle in circles[0, :]:
-                counter+=1
+            circles[0, :, 0] += x0
+            circles[0, :, 1] += y0
+            found.append(circles[0])
+    if len(found) == 0:
+        return None
+    return numpy.concatenate(found)[numpy.newaxis]
 
-                if circle[2] >= big:
-                    big = circle[2]
-                    bigcircle = circle
 
+# Canny thresholds for the edges Hough looks for circles in
+CANNY_THRESHOLDS = (100, 200)
+
+
+def find_hough_circles(edges: numpy.ndarray, mask: numpy.ndarray, app_context: app_contexts.AppContext) -> typing.Optional[numpy.ndarray]:
+    """
+    :param edges: The edges of the cleaned up mask
+    :param mask: The cleaned up color mask
+
+    :return: The circles cv2.HoughCircles finds, in the whole frame or only
+                around the color blobs, or None
+    """
+
+    if app_context.pipeline_context.hough_roi:
+        return find_circles_in_blobs(edges, mask, app_context)
+    return cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT,
+                            dp=app_context.circle_context.dp, minDist=100,
+                            param1=app_context.circle_context.param1,
+                            param2=app_context.circle_context.param2,
+                            minRadius=10,maxRadius=200)
+
+
+def pick_circle(edges: numpy.ndarray, circles: typing.Optional[numpy.ndarray], app_context: app_contexts.AppContext) -> typing.Optional[numpy.ndarray]:
+    """
+    :param edges: The edges the circles were found in
+    :param circles: The result of find_hough_circles
+
+    :return: The largest circle that passes the circle_score filters, as
+                (x, y, radius), or None
+    """
+
+    bigcircle=None
+    if circles is not None:
+        circles = circle_score.filter_by_composite_score(edges, numpy.around(circles[0]), app_context.circle_context.circle_filter_b, app_context.circle_context.circle_filter_m)
+        circles = numpy.uint16(numpy.around(circles))
+        big=0
+        for circle in circles[0, :]:
+            if circle[2] >= big:
+                big = circle[2]
+                bigcircle = circle
+    return bigcircle
+
+
+def find_circle_in_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.Tuple[typing.Optional[numpy.ndarray], typing.Optional[video_stream.TimedFrame]]:
+    try:
+        start_time = time.perf_counter()
+        if image_frame.frame is None:
+            return None, image_frame
+
+        mask = get_frame_mask(image_frame.frame, app_context)
+        logger.debug("color filter time %.2fms", (time.perf_counter()-start_time)*1000)
+        start_time = time.perf_counter()
+        opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, opening_kernel, dst=scratch.get("opening", mask.shape))
+
+        median = cv2.medianBlur(opening, 5, dst=scratch.get("median", mask.shape))
+        logger.debug("filters time %.2fms", (time.perf_counter()-start_time)*1000)
+        start_time = time.perf_counter()
+        edges = cv2.Canny(median, *CANNY_THRESHOLDS, edges=scratch.get("edges", mask.shape))
+
+        circles = find_hough_circles(edges, median, app_context)
+        logger.debug("hough time %.2fms", (time.perf_counter()-start_time)*1000)
+        start_time = time.perf_counter()
+
+        bigcircle = pick_circle(edges, circles, app_context)
+        logger.debug("circle filter time %.2fms", (time.perf_counter()-start_time)*1000)
         return bigcircle, image_frame
 
     except Exception:
@@ -81,54 +169,292 @@ def find_circle_in_image(image_frame: video_stream.TimedFrame, app_context: app_
         # print(error)
     return None, None
 
-def find_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.Tuple[typing.Optional[numpy.ndarray], typing.Optional[video_stream.TimedFrame]]:
-    try:
-        start_time = time.time()
-        if image_frame.frame is None:
-            return None, image_frame
+# Candidates smaller than this many pixels at full resolution are noise
+MIN_TARGET_AREA = 20
+# Most candidates measured and published per frame
+MAX_TARGETS = 8
+
+
+class Target(typing.NamedTuple):
+    """
+    One candidate ball
+    """
+
+    # Centroid of the blob's pixels
+    x: float
+    y: float
+    # Radius of the smallest circle enclosing the blob
+    radius: float
+    # Area inside the blob's outline, in pixels
+    area: float
+    # How much of the enclosing circle the blob fills, 1 for a full disc
+    score: float
+    # Bounding rectangle (x, y, w, h)
+    rect: typing.Tuple[int, int, int, int]
+
+    def moved(self, dx: float, dy: float, scale: float=1) -> "Target":
+        """
+        :return: The target scaled by scale, then moved by (dx, dy)
+        """
+
+        x, y, w, h = self.rect
+        return Target(self.x * scale + dx, self.y * scale + dy, self.radius * scale, self.area * scale * scale, self.score,
+                        (int(x * scale + dx), int(y * scale + dy), int(round(w * scale)), int(round(h * scale))))
+
+
+def get_blob_mask(frame: numpy.ndarray, app_context: app_contexts.AppContext) -> numpy.ndarray:
+    """
+    Masks the team color and cleans up the mask with an opening and a median
+    blur
 
-        mask = get_color_filter_mask(image_frame.frame, app_context.color_context)
-        logger.debug("color filter time %d", time.time()-start_time)
-        start_time = time.time()
-        kernel = numpy.ones((10, 10), numpy.uint8)
-        #cv2.imshow("mask", image_frame.frame)
-        #.waitKey()
+    :param frame: The BGR image, or a region of it
+    :param app_context: The colors to look for
+    """
 
-       # image_frame = mask
-        opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    start_time = time.perf_counter()
+    mask = get_frame_mask(frame, app_context)
+    logger.debug("color filter time %.2fms", (time.perf_counter()-start_time)*1000)
+    start_time = time.perf_counter()
+    #cv2.imshow("mask", image_frame.frame)
+    #.waitKey()
 
-        median = cv2.medianBlur(opening,5)
-        logger.debug("filters time %d", time.time()-start_time)
-        start_time = time.time()
+   # image_frame = mask
+    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, opening_kernel, dst=scratch.get("opening", mask.shape))
 
+    median = cv2.medianBlur(opening, 5, dst=scratch.get("median", mask.shape))
+    logger.debug("filters time %.2fms", (time.perf_counter()-start_time)*1000)
+    return median
 
-        #edges = cv2.Canny(median, 100, 200)
-        #cv2.imshow("mask", edges)
-        #cv2.waitKey()
 
-        contours, hierarchy = cv2.findContours(median, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        if(len(contours) ==0):
+def find_targets_in_mask(mask: numpy.ndarray, max_targets: int=MAX_TARGETS, min_area: float=MIN_TARGET_AREA) -> typing.List[Target]:
+    """
+    Measures the blobs of a mask from their outer contours
+
+    :param mask: The cleaned up color mask
+    :param max_targets: How many of the largest blobs to measure
+    :param min_area: Blobs smaller than this are ignored
+
+    :return: The targets, largest first
+    """
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    areas = [cv2.contourArea(contour) for contour in contours]
+    targets = []
+    for index in sorted(range(len(contours)), key=areas.__getitem__, reverse=True)[:max_targets]:
+        area = areas[index]
+        if area < min_area:
+            break
+        contour = contours[index]
+        M = cv2.moments(contour)
+        _, radius = cv2.minEnclosingCircle(contour)
+        score = min(1.0, area / (math.pi * radius * radius)) if radius > 0 else 0.0
+        targets.append(Target(M['m10']/M['m00'], M['m01']/M['m00'], float(radius), area, score, cv2.boundingRect(contour)))
+    return targets
+
+
+def find_targets(frame: numpy.ndarray, app_context: app_contexts.AppContext, max_targets: int=MAX_TARGETS) -> typing.List[Target]:
+    """
+    Finds the blobs of the team color
+
+    :param frame: The BGR image, or a region of it
+    :param app_context: The colors to look for
+    :param max_targets: How many of the largest blobs to return
+
+    :return: The targets, largest first
+    """
+
+    mask = get_blob_mask(frame, app_context)
+    start_time = time.perf_counter()
+    targets = find_targets_in_mask(mask, max_targets)
+    logger.debug("targets time %.2fms", (time.perf_counter()-start_time)*1000)
+    return targets
+
+
+def find_largest_blob(frame: numpy.ndarray, app_context: app_contexts.AppContext) -> typing.Optional[Target]:
+    """
+    Finds the largest blob of the team color
+
+    :param frame: The BGR image, or a region of it
+    :param app_context: The colors to look for
+
+    :return: The blob, or None
+    """
+
+    targets = find_targets(frame, app_context, max_targets=1)
+    return targets[0] if len(targets) > 0 else None
+
+
+def get_pyramid_filters(scale: int) -> typing.Tuple[numpy.ndarray, int]:
+    """
+    :param scale: How much the frame is shrunk by
+
+    :return: The opening kernel and median blur size that do at the reduced
+                scale what the 10x10 opening and 5x5 median do at full scale
+    """
+
+    kernel_size = max(1, round(10 / scale))
+    median_size = max(1, round(5 / scale)) | 1
+    return numpy.ones((kernel_size, kernel_size), numpy.uint8), median_size
+
+
+def get_refine_margin(scale: int) -> int:
+    # Room for the pixels lost to downscaling and the 10x10 opening
+    return 10 + 2 * scale
+
+
+def find_coarse_targets(frame: numpy.ndarray, app_context: app_contexts.AppContext, scale: int,
+                        max_targets: int=MAX_TARGETS) -> typing.List[Target]:
+    """
+    Finds the blobs on a downscaled copy of the frame
+
+    :param frame: The full resolution BGR image
+    :param app_context: The colors to look for
+    :param scale: How much to shrink the frame by
+    :param max_targets: How many of the largest blobs to return
+
+    :return: The targets in full resolution coordinates, largest first
+    """
+
+    height, width = frame.shape[:2]
+    small_size = (max(1, width // scale), max(1, height // scale))
+    small = cv2.resize(frame, small_size, dst=scratch.get("pyramid", (small_size[1], small_size[0]) + frame.shape[2:]),
+                        interpolation=cv2.INTER_AREA)
+
+    mask = get_frame_mask(small, app_context)
+    kernel, median_size = get_pyramid_filters(scale)
+    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, dst=scratch.get("opening", mask.shape))
+    if median_size > 1:
+        opening = cv2.medianBlur(opening, median_size, dst=scratch.get("median", mask.shape))
+
+    scale_x = width / small_size[0]
+    targets = find_targets_in_mask(opening, max_targets, MIN_TARGET_AREA / (scale_x * scale_x))
+    return [target.moved(0, 0, scale_x) for target in targets]
+
+
+def refine_blob(frame: numpy.ndarray, app_context: app_contexts.AppContext, coarse: Target, margin: int) -> Target:
+    """
+    Measures a coarse blob again at full resolution, in a window around it
+
+    :param coarse: The blob found at a reduced scale
+    :param margin: Pixels added around the blob's bounding rectangle
+
+    :return: The blob measured at full resolution
+    """
+
+    x, y, w, h = coarse.rect
+    window = tracking.Window(
+        max(x - margin, 0),
+        max(y - margin, 0),
+        min(x + w + margin, frame.shape[1]),
+        min(y + h + margin, frame.shape[0]),
+    )
+    blob = find_blob_in_window(frame, app_context, window, reject_cut_off=False)
+    if blob is None:
+        # The opening at full resolution can erase a blob that only just
+        # survived the coarse one, keep the coarse estimate then
+        return coarse
+    return blob
+
+
+def find_targets_pyramid(frame: numpy.ndarray, app_context: app_contexts.AppContext, scale: int) -> typing.List[Target]:
+    """
+    Finds the blobs on a downscaled frame, then refines each one's centroid
+    and radius at full resolution
+
+    :return: The targets, largest first
+    """
+
+    start_time = time.perf_counter()
+    coarse_targets = find_coarse_targets(frame, app_context, scale)
+    logger.debug("coarse search time %.2fms", (time.perf_counter()-start_time)*1000)
+
+    targets = []
+    for coarse in coarse_targets:
+        target = refine_blob(frame, app_context, coarse, get_refine_margin(scale))
+        # Windows of blobs close together can refine to the same blob
+        if all(target.rect != other.rect for other in targets):
+            targets.append(target)
+    targets.sort(key=lambda target: target.area, reverse=True)
+    return targets
+
+
+def find_blob_in_window(frame: numpy.ndarray, app_context: app_contexts.AppContext, window: tracking.Window,
+                        reject_cut_off: bool=True) -> typing.Optional[Target]:
+    """
+    Looks for the largest blob inside a window of the frame only
+
+    :param reject_cut_off: Return None for a blob cut off by a window edge
+                            that is not a frame edge
+
+    :return: The blob in frame coordinates, or None if there is no blob
+    """
+
+    blob = find_largest_blob(frame[window.y0:window.y1, window.x0:window.x1], app_context)
+    if blob is None:
+        return None
+
+    x, y, w, h = blob.rect
+    cut_off = (x == 0 and window.x0 > 0) or (y == 0 and window.y0 > 0) or \
+        (x + w >= window.x1 - window.x0 and window.x1 < frame.shape[1]) or \
+        (y + h >= window.y1 - window.y0 and window.y1 < frame.shape[0])
+    if reject_cut_off and cut_off:
+        return None
+    return blob.moved(window.x0, window.y0)
+
+
+def find_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.AppContext) -> typing.Tuple[typing.Optional[typing.List[Target]], typing.Optional[video_stream.TimedFrame]]:
+    """
+    Finds the candidate balls in a frame
+
+    :return: The targets, largest first, and the frame they were found in, or
+                (None, None) if there are none
+    """
+
+    try:
+        if image_frame.frame is None:
+            return None, image_frame
+
+        tracking_enabled = app_context.pipeline_context.tracking
+        targets = []
+        if tracking_enabled:
+            # Search around where the ball should be first, then the whole
+            # frame. A window hit only reports the tracked ball.
+            window = tracker.predict(image_frame.time, image_frame.frame.shape)
+            if window is not None:
+                blob = find_blob_in_window(image_frame.frame, app_context, window)
+                if blob is not None:
+                    tracking_window_hits.inc()
+                    targets = [blob]
+                else:
+                    tracking_window_misses.inc()
+
+        if len(targets) == 0:
+            if app_context.pipeline_context.pyramid and app_context.pipeline_context.pyramid_scale > 1:
+                targets = find_targets_pyramid(image_frame.frame, app_context, app_context.pipeline_context.pyramid_scale)
+            else:
+                targets = find_targets(image_frame.frame, app_context)
+        if len(targets) == 0:
+            if tracking_enabled:
+                tracker.lose(image_frame.time)
             return None, None
-        c = max(contours, key = cv2.contourArea)
 
-        M = cv2.moments(c)
-        cx = int(M['m10']/M['m00'])
-        cy = int(M['m01']/M['m00'])
+        if tracking_enabled:
+            _, _, w, h = targets[0].rect
+            tracker.update(image_frame.time, targets[0].x, targets[0].y, max(w, h))
 
-        bigcircle=(cx, cy, .01)
         """
         circles = cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT,
                                     dp=app_context.circle_context.dp, minDist=100,
                                     param1=app_context.circle_context.param1,
                                     param2=app_context.circle_context.param2,
                                     minRadius=10,maxRadius=200)
-        logger.debug("hough time %d", time.time()-start_time)
-        start_time = time.time()
+        logger.debug("hough time %.2fms", (time.perf_counter()-start_time)*1000)
+        start_time = time.perf_counter()
 
         if circles is not None:
             circles = circle_score.filter_by_composite_score(edges, numpy.around(circles[0]), app_context.circle_context.circle_filter_b, app_context.circle_context.circle_filter_m)
-            logger.debug("circle filter time %d", time.time()-start_time)
-            start_time = time.time()
+            logger.debug("circle filter time %.2fms", (time.perf_counter()-start_time)*1000)
+            start_time = time.perf_counter()
             circles = numpy.uint16(numpy.around(circles))
             counter=0
             big=0
@@ -139,7 +465,7 @@ def find_image(image_frame: video_stream.TimedFrame, app_context: app_contexts.A
                     big = circle[2]
                     bigcircle = circle
         """
-        return bigcircle, image_frame
+        return targets, image_frame
 
     except Exception:
         logger.exception("Unable to find circle")
@@ -1,4 +1,4 @@
-import collections
+import itertools
 import math
 import os
 import pathlib
@@ -7,13 +7,18 @@ import threading
 import time
 import typing
 
-import cv2
-import numpy
-
-import app_contexts
+import config_store
+import detection_pool
+import frame_pool
+import frame_sources
+import governor
 import image_finder
 import logger
+import metrics
+import recorder
+import reorder
 import robot
+import scheduler
 import server
 import shared_context
 import video_stream
@@ -22,94 +27,251 @@ import video_stream
 logger.setLevel(logger.INFO)
 
 
-process_queue = collections.deque(maxlen=4)
-# process_queue_lock = threading.Lock()
-process_queue_condition = threading.Condition()
-ready_queue = collections.deque(maxlen=4)
-# ready_queue_lock = threading.Lock()
-ready_queue_condition = threading.Condition()
+# Capture buffers, created in main once the worker count is known
+frames: typing.Optional[frame_pool.FramePool] = None
+
+
+def release_frame(image_frame: typing.Optional[video_stream.TimedFrame]):
+    if frames is not None and image_frame is not None:
+        frames.release(image_frame.frame)
+
+
+def drop_frame(image_frame: video_stream.TimedFrame):
+    frames_dropped.inc()
+    result_reorder.skip(image_frame.sequence)
+    release_frame(image_frame)
+
+
+def drop_result(queued: typing.Tuple[video_stream.TimedFrame, detection_pool.DetectionResult]):
+    results_dropped.inc()
+    result_reorder.skip(queued[0].sequence)
+    release_frame(queued[0])
+
+
+# Frames waiting for a worker, created in main with the configured policy
+process_queue: typing.Optional[scheduler.FrameScheduler] = None
+# Results waiting to be published. send_results drains it on every wake, so
+# it only fills when publishing stalls, and then the oldest result is
+# dropped. Putting never blocks, the process backend publishes from the
+# executor's callback thread and a wait there would hold up every other
+# result.
+ready_queue = scheduler.BoundedFifo(4, block=False, on_drop=drop_result)
+# Publishes results in capture order and drops the ones that finish too late
+result_reorder = reorder.ReorderBuffer(on_drop=lambda queued: release_frame(queued[0]))
+
+frames_captured = metrics.counter("frames_captured_total", "Frames read from the frame source")
+frames_dropped = metrics.counter("frames_dropped_total", "Frames dropped before detection because the workers were busy")
+frames_skipped = metrics.counter("frames_skipped_total", "Frames the governor left out to lower the processed framerate")
+results_dropped = metrics.counter("results_dropped_total", "Results that fell off the ready queue before publishing")
+results_published = metrics.counter("results_published_total", "Results published to the robot")
+detection_latency = metrics.histogram("detection_seconds", "Time spent in the detector per frame")
+worker_busy_time = metrics.counter("worker_busy_seconds_total", "Time the workers spent detecting")
+workers_busy = metrics.gauge("workers_busy", "Workers currently detecting")
+worker_count = metrics.gauge("workers", "Number of detection workers")
+metrics.gauge("worker_utilization", "Fraction of the workers currently detecting",
+                lambda: min(1, workers_busy.value() / worker_count.value()) if worker_count.value() else 0)
+capture_to_publish_latency = metrics.histogram("capture_to_publish_seconds", "Time from capture to publishing the result")
+capture_to_publish_max = metrics.gauge("capture_to_publish_max_seconds", "Longest time from capture to publishing a result")
+metrics.gauge("process_queue_depth", "Frames waiting for a worker", lambda: len(process_queue) if process_queue is not None else 0)
+metrics.gauge("ready_queue_depth", "Results waiting to be published", lambda: len(ready_queue))
+metrics.gauge("stale_results_dropped", "Results dropped because a newer one was already published", lambda: result_reorder.dropped)
+
+
+def get_frame_pool(resolution: typing.Tuple[int, int]) -> frame_pool.FramePool:
+    """
+    :return: The capture buffers, replaced with buffers of the new size when
+                the resolution changes. Frames still out from the old pool
+                are simply not taken back when they are released.
+    """
+
+    global frames
+    shape = (resolution[1], resolution[0], 3)
+    if frames.shape != shape:
+        logger.info("Capturing at %dx%d", resolution[0], resolution[1])
+        frames = frame_pool.FramePool(len(frames.buffers), shape)
+    return frames
+
 
+def get_frame_counts() -> typing.Tuple[float, float]:
+    # Skipped frames never reach the workers, so they can't be dropped either
+    return frames_captured.value() - frames_skipped.value(), frames_dropped.value()
 
-def filter_frame(frame: numpy.ndarray):
-    return cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
 
+def read_images(pipeline_governor: governor.Governor, pool: typing.Optional[detection_pool.DetectionPool] = None, source: str = "picamera"):
+    # Numbered here rather than by the source, so numbers keep increasing
+    # when the source is opened again at a new resolution
+    sequence = itertools.count()
+    frame_count = 0
+    point = pipeline_governor.operating_point
+    frame_source = frame_sources.open_frame_source(source, point.resolution, point.framerate, frame_pool=get_frame_pool(point.resolution))
+    while True:
+        images = iter(frame_source)
+        reopen = False
+        for image in images:
+            frames_captured.inc()
+            if pipeline_governor.update(time.monotonic(), get_frame_counts):
+                point = pipeline_governor.operating_point
+                logger.info("Governor moved to %s", point)
+                if not frame_source.reconfigure(point.resolution, point.framerate, get_frame_pool(point.resolution)):
+                    release_frame(image)
+                    reopen = True
+                    break
+
+            # Frames are stepped over before they are numbered, so the reorder
+            # buffer never waits for them
+            frame_count += 1
+            if frame_count < point.skip:
+                frames_skipped.inc()
+                release_frame(image)
+                continue
+            frame_count = 0
+            image = image._replace(sequence=next(sequence))
 
-def read_images(resolution: typing.Tuple[int, int] = (320, 240), fps: int = 30):
-    global total_images_read
-    for image in video_stream.transform_images(video_stream.get_images(resolution, fps), filter_frame):
-        with process_queue_condition:
-            process_queue.append(image)
-            process_queue_condition.notify_all()
+            # Frames stay BGR, the detectors convert or mask them as configured
+            if pool is not None:
+                if not pool.submit(image, shared_context.config.snapshot()):
+                    drop_frame(image)
+                continue
+            process_queue.put(image)
 
+        if not reopen:
+            return
+        images.close()
+        frame_source = frame_sources.open_frame_source(source, point.resolution, point.framerate, frame_pool=frames)
 
-def process_images(app_context: app_contexts.AppContext):
+
+def process_images(config: config_store.ConfigStore, worker: int = 0):
     global total_images_processed
     while True:
-        with process_queue_condition:
-            while len(process_queue) == 0:
-                process_queue_condition.wait()
-            image_frame: video_stream.TimedFrame = process_queue.popleft()
+        image_frame: video_stream.TimedFrame = process_queue.get(worker)
+
+        workers_busy.inc()
+        start_time = time.perf_counter()
+        result = image_finder.find_image(image_frame, config.snapshot())
+        elapsed = time.perf_counter() - start_time
+        workers_busy.dec()
+        detection_latency.observe(elapsed)
+        worker_busy_time.inc(elapsed)
+
+        publish_result(image_frame, result)
 
-        with ready_queue_condition:
-            ready_queue.append(image_finder.find_image(image_frame, app_context))
-            ready_queue_condition.notify_all()
 
+def publish_result(image_frame: video_stream.TimedFrame, result: detection_pool.DetectionResult):
+    ready_queue.put((image_frame, result))
 
-def send_results(robot_connection: robot.RobotConnection, resolution: typing.Tuple[int, int] = (320, 240), last_seen: typing.Optional[shared_context.LastFrame] = None):
-    half_h_fov = resolution[0]/2
+
+def send_results(robot_connection: robot.RobotConnection, pipeline_governor: governor.Governor, last_seen: typing.Optional[shared_context.LastFrame] = None,
+                    frame_recorder: typing.Optional[recorder.FrameRecorder] = None):
     tan_h_fov = math.tan(.5427974) #half the HFOV degrees 31.1 to rad
-    k = tan_h_fov/half_h_fov
 
     while True:
-        with ready_queue_condition:
-            while len(ready_queue) == 0:
-                ready_queue_condition.wait()
-            result = ready_queue.popleft()
-            if not result:
-                continue
+        dropped = result_reorder.dropped
+        # Wake up for new results or when a held one has waited long enough
+        queued = ready_queue.get_all(result_reorder.time_to_release(time.monotonic()))
+        now = time.monotonic()
+        for image_frame, result in queued:
+            result_reorder.push(image_frame.sequence, (image_frame, result), now)
+
+        for image_frame, result in result_reorder.pop_ready(time.monotonic()):
+            results_published.inc()
+            latency = time.monotonic() - image_frame.time
+            capture_to_publish_latency.observe(latency)
+            pipeline_governor.observe(latency)
+            if latency > capture_to_publish_max.value():
+                capture_to_publish_max.set(latency)
+
+            targets: typing.Optional[typing.List[image_finder.Target]] = result[0] if result else None
+            if result:
+                # The resolution can change from one frame to the next
+                half_h_fov = image_frame.frame.shape[1]/2
+                k = tan_h_fov/half_h_fov
 
-            circle: numpy.ndarray = result[0]
-            timed_frame: video_stream.TimedFrame = result[1]
-            if last_seen and timed_frame:
-                last_seen.set_frame_and_circle(timed_frame.frame, circle)
-            if circle is None or len(circle) == 0:
-                robot_connection.put_circle("SmartDashboard", None)
+                robot_connection.put_latency("SmartDashboard", image_frame.time, latency)
+                robot_connection.put_targets("SmartDashboard", [
+                    robot.CircleDefinition(
+                        target.x,
+                        target.y,
+                        target.radius,
+                        math.atan((target.x - half_h_fov) * k) * 57.2958, #convert rad to deg
+                        target.area,
+                        target.score,
+                    )
+                    for target in targets or []
+                ])
+
+            if frame_recorder is not None:
+                # After the robot has the result, so recording never adds to
+                # its latency. Copies the frame, so it can still be released
+                # below.
+                frame_recorder.record(image_frame, targets)
+
+            timed_frame: typing.Optional[video_stream.TimedFrame] = result[1] if result else None
+            if not timed_frame or not last_seen:
+                # Nothing keeps the frame past this point
+                release_frame(image_frame)
                 continue
 
-            x, y, radius = circle
-            angle_x = math.atan((x - half_h_fov) * k) * 57.2958 #convert rad to deg
-            robot_connection.put_circle("SmartDashboard", robot.CircleDefinition(
-                x,
-                y,
-                radius,
-                angle_x,
-            ))
+            circle = (targets[0].x, targets[0].y, targets[0].radius) if targets else None
+            previous = last_seen.set_frame_and_circle(timed_frame.frame, circle)
+            if frames is not None:
+                frames.release(previous)
+        if result_reorder.dropped != dropped:
+            logger.debug("Dropped %d stale results, %d total", result_reorder.dropped - dropped, result_reorder.dropped)
 
 
 def main():
+    global frames, process_queue
     process_threads = []
-    thread_count = (os.cpu_count() or 4) - 1
-    for i in range(0, thread_count):
-        process_thread = threading.Thread(target=process_images, args=(shared_context.app_context,))
-        process_thread.daemon = True
-        process_thread.start()
-        process_threads.append(process_thread)
+    pool = None
+    thread_count = shared_context.worker_count or (os.cpu_count() or 4) - 1
+    worker_count.set(thread_count)
+    process_queue = scheduler.create_scheduler(shared_context.scheduler_policy, thread_count, shared_context.queue_depth, drop_frame)
+    logger.info("Scheduling frames with the %s policy", shared_context.scheduler_policy)
+    # Enough buffers for every frame that can be queued, in a worker, waiting
+    # to be put back in order, published or shown as the last seen frame at once
+    frames = frame_pool.FramePool(2 * thread_count + shared_context.queue_depth + ready_queue.capacity + 8,
+                                    (shared_context.resolution[1], shared_context.resolution[0], 3))
+    if shared_context.detection_backend == "process":
+        logger.info("Running detection in %d worker processes", thread_count)
+        pool = detection_pool.DetectionPool(shared_context.resolution, thread_count, image_finder.find_image, publish_result)
+    else:
+        logger.info("Running detection in %d worker threads", thread_count)
+        for i in range(0, thread_count):
+            process_thread = threading.Thread(target=process_images, args=(shared_context.config, i))
+            process_thread.daemon = True
+            process_thread.start()
+            process_threads.append(process_thread)
 
 
 
-    read_thread = threading.Thread(target=read_images, args=(shared_context.resolution, 30))
+    read_thread = threading.Thread(target=read_images, args=(shared_context.pipeline_governor, pool, shared_context.frame_source))
     read_thread.daemon = True
     read_thread.start()
 
     robot_connection = robot.RobotConnection("10.57.36.2", fake=False)
     robot_connection.connect()
+    robot_connection.sync_clock("SmartDashboard")
+
+    frame_recorder = None
+    if shared_context.record_directory:
+        logger.info("Recording frames to %s", shared_context.record_directory)
+        frame_recorder = recorder.FrameRecorder(
+            pathlib.Path(shared_context.record_directory),
+            shared_context.record_segment_mb * 1024 * 1024,
+            shared_context.record_max_mb // shared_context.record_segment_mb,
+            shared_context.record_encoding,
+        )
 
-    send_thread = threading.Thread(target=send_results, args=(robot_connection, shared_context.resolution, shared_context.last_seen))
+    send_thread = threading.Thread(target=send_results, args=(robot_connection, shared_context.pipeline_governor, shared_context.last_seen, frame_recorder))
     send_thread.daemon = True
     send_thread.start()
-    # send_results(robot_connection, shared_context.resolution, shared_context.last_seen)
+    # send_results(robot_connection, shared_context.pipeline_governor, shared_context.last_seen)
 
-    server.start_server()
+    try:
+        server.start_server()
+    finally:
+        if pool is not None:
+            pool.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+import bisect
+import math
+import threading
+import typing
+
+
+# Latency buckets in seconds, shared by the pipeline histograms
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class _ThreadShards:
+    """
+    Per-thread copies of a metric's state
+
+    Each thread only ever writes its own shard, so updates need no lock. The
+    lock is only taken the first time a thread touches the metric and when
+    reading. Shards of threads that have exited (e.g. finished Flask request
+    threads) are folded into one retired shard so they don't pile up.
+    """
+
+    def __init__(self, factory: typing.Callable[[], list]):
+        self._factory = factory
+        self._local = threading.local()
+        self._shards: typing.List[typing.Tuple[threading.Thread, list]] = []
+        self._retired = factory()
+        self._lock = threading.Lock()
+
+    def get(self) -> list:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._factory()
+            with self._lock:
+                self._retire_dead_threads()
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+        return shard
+
+    def all(self) -> typing.List[list]:
+        with self._lock:
+            self._retire_dead_threads()
+            return [list(self._retired)] + [shard for _, shard in self._shards]
+
+    def _retire_dead_threads(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+                continue
+            for index in range(len(shard)):
+                self._retired[index] += shard[index]
+        self._shards = alive
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._shards = _ThreadShards(lambda: [0])
+
+    def inc(self, amount: float=1):
+        self._shards.get()[0] += amount
+
+    def value(self) -> float:
+        return sum(shard[0] for shard in self._shards.all())
+
+    def to_json(self):
+        return self.value()
+
+    def to_prometheus(self) -> typing.List[str]:
+        return [f"{self.name} {_format_number(self.value())}"]
+
+
+class Gauge:
+    """
+    A value that goes up and down. It is either set directly, moved with
+    inc/dec from any thread, or read from a function when the metrics are
+    collected.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, function: typing.Optional[typing.Callable[[], float]]=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self._value = 0.0
+        self._shards = _ThreadShards(lambda: [0])
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float=1):
+        self._shards.get()[0] += amount
+
+    def dec(self, amount: float=1):
+        self._shards.get()[0] -= amount
+
+    def value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._value + sum(shard[0] for shard in self._shards.all())
+
+    def to_json(self):
+        return self.value()
+
+    def to_prometheus(self) -> typing.List[str]:
+        return [f"{self.name} {_format_number(self.value())}"]
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, like a Prometheus histogram
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: typing.Sequence[float]=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, one for +Inf, then the sum of all observations
+        self._shards = _ThreadShards(lambda: [0] * (len(self.buckets) + 2))
+
+    def observe(self, value: float):
+        shard = self._shards.get()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> typing.Tuple[typing.List[int], float]:
+        """
+        :return: The count in each bucket (not cumulative, last one is +Inf)
+                    and the sum of all observations
+        """
+
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for shard in self._shards.all():
+            for index in range(len(counts)):
+                counts[index] += shard[index]
+            total += shard[-1]
+        return counts, total
+
+    def quantile(self, quantile: float) -> float:
+        """
+        :return: The upper bound of the bucket the quantile falls in
+        """
+
+        counts, _ = self.snapshot()
+        target = quantile * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count > 0 and seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else math.inf
+        return 0.0
+
+    def to_json(self):
+        counts, total = self.snapshot()
+        count = sum(counts)
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count > 0 else 0.0,
+            "p50": _finite_or_none(self.quantile(.5)),
+            "p99": _finite_or_none(self.quantile(.99)),
+            "buckets": {_format_number(bound): bucket_count for bound, bucket_count in zip(self.buckets + (math.inf,), counts)},
+        }
+
+    def to_prometheus(self) -> typing.List[str]:
+        counts, total = self.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_number(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format_number(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+Metric = typing.Union[Counter, Gauge, Histogram]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: typing.Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric_type: type, name: str, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_type(name, *args, **kwargs)
+                self.metrics[name] = metric
+            elif type(metric) != metric_type:
+                raise ValueError(f"Metric {name} is already a {metric.type}")
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter, name, help)
+
+    def gauge(self, name: str, help: str, function: typing.Optional[typing.Callable[[], float]]=None) -> Gauge:
+        return self._register(Gauge, name, help, function)
+
+    def histogram(self, name: str, help: str, buckets: typing.Sequence[float]=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, buckets)
+
+    def to_json(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.to_json() for metric in metrics}
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+
+def _format_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _finite_or_none(value: float) -> typing.Optional[float]:
+    return value if math.isfinite(value) else None
+
+
+registry = MetricsRegistry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
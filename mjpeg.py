@@ -0,0 +1,142 @@
+import threading
+import time
+import typing
+
+import cv2
+
+import app_contexts
+import logger
+import metrics
+import shared_context
+
+
+BOUNDARY = "frame"
+CONTENT_TYPE = f"multipart/x-mixed-replace; boundary={BOUNDARY}"
+# Longest a client goes without being sent anything, the server only notices
+# a client left when a write to it fails
+KEEP_ALIVE_INTERVAL = 1.0
+
+encoded_frames = metrics.counter("mjpeg_frames_encoded_total", "Frames encoded for the MJPEG stream")
+stream_clients = metrics.gauge("mjpeg_clients", "Clients watching the MJPEG stream")
+
+
+def encode_jpeg(frame, circle, scale: float=1, quality: int=95) -> bytes:
+    """
+    Draws the circle on the frame, scales it and encodes it as a JPEG
+
+    :param frame: The BGR frame, drawn on in place
+    :param circle: (x, y, radius) or None
+    """
+
+    if circle is not None:
+        x, y, radius = circle
+        cv2.circle(frame, (int(x), int(y)), int(radius), (0, 255, 0), 5)
+    if scale != 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def encode_frame(frame, circle, stream_context: app_contexts.StreamContext) -> bytes:
+    """
+    Encodes the frame as one part of the multipart stream
+    """
+
+    jpeg = encode_jpeg(frame, circle, stream_context.scale, stream_context.quality)
+    return b"".join((
+        f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode(),
+        jpeg,
+        b"\r\n",
+    ))
+
+
+class MjpegStream:
+    """
+    Encodes the last seen frame once and hands the same bytes to every
+    client watching the stream
+
+    One encoder thread runs while at least one client is connected and exits
+    when the last one leaves. Clients that fall behind skip straight to the
+    newest frame instead of queueing old ones. When no new frame comes, every
+    client is sent the newest one again each KEEP_ALIVE_INTERVAL, so clients
+    that left are noticed even while the camera is stalled.
+
+    :param last_seen: The frames to stream
+    :param get_stream_context: Returns the current stream settings
+    """
+
+    def __init__(self, last_seen: shared_context.LastFrame, get_stream_context: typing.Callable[[], app_contexts.StreamContext]):
+        self.last_seen = last_seen
+        self.get_stream_context = get_stream_context
+
+        self.client_count = 0
+        self.encoder: typing.Optional[threading.Thread] = None
+        # The newest encoded part and how many have been encoded so far
+        self.part: typing.Optional[bytes] = None
+        self.part_number = 0
+        self.condition = threading.Condition()
+
+    def _encode(self):
+        version = None
+        next_frame_time = 0.0
+        while True:
+            with self.condition:
+                if self.client_count == 0:
+                    self.encoder = None
+                    self.part = None
+                    return
+
+            stream_context = self.get_stream_context()
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            # Wake up now and then to notice when every client has left
+            frame, circle, frame_version = self.last_seen.wait_for_frame(version, timeout=1.0)
+            if frame is None:
+                continue
+            version = frame_version
+            next_frame_time = time.monotonic() + 1 / max(stream_context.max_fps, 0.1)
+
+            try:
+                part = encode_frame(frame, circle, stream_context)
+            except Exception:
+                logger.exception("Unable to encode stream frame")
+                continue
+            encoded_frames.inc()
+
+            with self.condition:
+                self.part = part
+                self.part_number += 1
+                self.condition.notify_all()
+
+    def parts(self) -> typing.Iterator[bytes]:
+        """
+        Yields the stream's parts for one client, starting the encoder if it
+        is the first one
+        """
+
+        with self.condition:
+            self.client_count += 1
+            stream_clients.inc()
+            if self.encoder is None:
+                self.encoder = threading.Thread(target=self._encode)
+                self.encoder.daemon = True
+                self.encoder.start()
+            # Send the newest part right away if there is one
+            part_number = self.part_number - 1 if self.part is not None else self.part_number
+
+        try:
+            while True:
+                with self.condition:
+                    if self.condition.wait_for(lambda: self.part_number != part_number and self.part is not None, KEEP_ALIVE_INTERVAL):
+                        part_number = self.part_number
+                    part = self.part
+                # Without a new frame, send the newest one again, or a blank
+                # line before the first one, which viewers ignore
+                yield part if part is not None else b"\r\n"
+        finally:
+            with self.condition:
+                self.client_count -= 1
+                stream_clients.dec()
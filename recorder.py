@@ -0,0 +1,299 @@
+import json
+import mmap
+import os
+import pathlib
+import queue
+import struct
+import threading
+import time
+import typing
+
+import cv2
+import numpy
+
+import frame_pool
+import image_finder
+import logger
+import metrics
+import video_stream
+
+
+SEGMENT_SUFFIX = ".pvseg"
+SEGMENT_MAGIC = b"PVSEG\0\0\0"
+SEGMENT_VERSION = 1
+# Magic, version
+SEGMENT_HEADER = struct.Struct("<8sI")
+RECORD_MAGIC = b"PVFR"
+# Magic, sequence, capture time, wall clock time, width, height, channels,
+# encoding, payload size, result size
+RECORD_HEADER = struct.Struct("<4sQddHHBBII")
+
+ENCODING_RAW = 0
+ENCODING_JPEG = 1
+ENCODINGS = {"raw": ENCODING_RAW, "jpeg": ENCODING_JPEG}
+
+frames_recorded = metrics.counter("recorder_frames_written_total", "Frames written to the recording")
+frames_not_recorded = metrics.counter("recorder_frames_dropped_total", "Frames left out of the recording because the writer fell behind")
+bytes_recorded = metrics.counter("recorder_bytes_written_total", "Bytes written to the recording")
+
+
+class RecordedFrame(typing.NamedTuple):
+    frame: numpy.ndarray
+    # On the time.monotonic() clock of the run that recorded it
+    time: float
+    sequence: int
+    # time.time() when the frame was captured
+    wall_time: float
+    # The targets the pipeline published for the frame
+    targets: typing.List[image_finder.Target]
+
+
+def segment_path(directory: pathlib.Path, index: int) -> pathlib.Path:
+    return directory / f"segment-{index:06d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory: pathlib.Path) -> typing.List[pathlib.Path]:
+    """
+    :return: The segment files in the directory, oldest first
+    """
+
+    return sorted(pathlib.Path(directory).glob(f"segment-*{SEGMENT_SUFFIX}"))
+
+
+def _segment_index(path: pathlib.Path) -> int:
+    return int(path.stem.split("-")[1])
+
+
+def _encode_targets(targets: typing.Optional[typing.Sequence[image_finder.Target]]) -> bytes:
+    return json.dumps([target._asdict() for target in targets or []]).encode()
+
+
+def _decode_targets(data: bytes) -> typing.List[image_finder.Target]:
+    targets = []
+    for target in json.loads(data):
+        target["rect"] = tuple(target["rect"])
+        targets.append(image_finder.Target(**target))
+    return targets
+
+
+class Segment:
+    """
+    One preallocated segment file, written through a memory map
+
+    The file is its full size from the start, so writing a frame never grows
+    it. Unwritten space stays zero, which is where readers stop.
+    """
+
+    def __init__(self, path: pathlib.Path, size: int):
+        self.path = path
+        self.size = size
+        with open(path, "wb") as file:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file.fileno(), 0, size)
+            else:
+                file.truncate(size)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size)
+        SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, SEGMENT_VERSION)
+        self.offset = SEGMENT_HEADER.size
+
+    def has_room(self, size: int) -> bool:
+        # Keep room for a zeroed header after the last record
+        return self.offset + size + RECORD_HEADER.size <= self.size
+
+    def write(self, header: bytes, *parts: bytes):
+        # The header goes in last, so a reader never finds a record whose
+        # data isn't there yet
+        offset = self.offset + len(header)
+        for part in parts:
+            self.map[offset:offset + len(part)] = part
+            offset += len(part)
+        self.map[self.offset:self.offset + len(header)] = header
+        self.offset = offset
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class FrameRecorder:
+    """
+    Records published frames with their targets to a ring of segment files
+
+    record only copies the frame into a buffer and queues it, a background
+    thread encodes it and writes it out, so capture and detection never wait
+    on the disk. When the writer falls behind, new frames are left out of
+    the recording instead of queueing up. Once more than max_segments
+    segments exist the oldest one is deleted, so the recording never takes
+    more than max_segments * segment_size bytes.
+
+    :param directory: Where to put the segment files
+    :param segment_size: Bytes per segment file
+    :param max_segments: Segment files to keep
+    :param encoding: "raw" for the frames as they are, "jpeg" to compress them
+    :param quality: JPEG quality
+    :param queue_size: Frames that may wait for the writer
+    """
+
+    def __init__(self, directory: pathlib.Path, segment_size: int=64 * 1024 * 1024, max_segments: int=8,
+                    encoding: str="raw", quality: int=90, queue_size: int=16):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown recording encoding {encoding}")
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self.encoding = ENCODINGS[encoding]
+        self.quality = quality
+
+        # Copies of the frames waiting for the writer
+        self.buffers: typing.Optional[frame_pool.FramePool] = None
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.queue_size = queue_size
+
+        segments = list_segments(self.directory)
+        self.next_index = _segment_index(segments[-1]) + 1 if segments else 0
+        self.segment: typing.Optional[Segment] = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, image_frame: video_stream.TimedFrame, targets: typing.Optional[typing.Sequence[image_finder.Target]]) -> bool:
+        """
+        Queues a frame to be recorded, never blocks
+
+        :return: False if the frame was left out of the recording
+        """
+
+        if self.queue.full():
+            frames_not_recorded.inc()
+            return False
+
+        frame = image_frame.frame
+        if self.buffers is None or self.buffers.shape != frame.shape:
+            self.buffers = frame_pool.FramePool(self.queue_size + 1, frame.shape, frame.dtype)
+        buffers = self.buffers
+        buffer = buffers.acquire(frame.shape)
+        numpy.copyto(buffer, frame)
+        wall_time = time.time() - (time.monotonic() - image_frame.time)
+        try:
+            self.queue.put_nowait((buffers, buffer, image_frame.time, image_frame.sequence, wall_time, list(targets or [])))
+        except queue.Full:
+            frames_not_recorded.inc()
+            buffers.release(buffer)
+            return False
+        return True
+
+    def flush(self):
+        """
+        Waits for the queued frames to be written
+        """
+
+        self.queue.join()
+        if self.segment is not None:
+            self.segment.map.flush()
+
+    def _encode(self, frame: numpy.ndarray) -> bytes:
+        if self.encoding == ENCODING_JPEG:
+            _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return buffer.tobytes()
+        return numpy.ascontiguousarray(frame).data.cast("B")
+
+    def _next_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = Segment(segment_path(self.directory, self.next_index), self.segment_size)
+        self.next_index += 1
+
+        segments = list_segments(self.directory)
+        for path in segments[:max(0, len(segments) - self.max_segments)]:
+            try:
+                path.unlink()
+            except OSError:
+                logger.exception("Unable to delete old recording %s", path)
+
+    def _write(self, frame: numpy.ndarray, capture_time: float, sequence: int, wall_time: float, targets: typing.List[image_finder.Target]):
+        payload = self._encode(frame)
+        result = _encode_targets(targets)
+        size = RECORD_HEADER.size + len(payload) + len(result)
+        if SEGMENT_HEADER.size + size + RECORD_HEADER.size > self.segment_size:
+            logger.warning("Frame of %d bytes does not fit in a %d byte segment", size, self.segment_size)
+            frames_not_recorded.inc()
+            return
+
+        if self.segment is None or not self.segment.has_room(size):
+            self._next_segment()
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        header = RECORD_HEADER.pack(RECORD_MAGIC, sequence, capture_time, wall_time, frame.shape[1], frame.shape[0],
+                                    channels, self.encoding, len(payload), len(result))
+        self.segment.write(header, payload, result)
+        frames_recorded.inc()
+        bytes_recorded.inc(size)
+
+    def _run(self):
+        while True:
+            buffers, buffer, capture_time, sequence, wall_time, targets = self.queue.get()
+            try:
+                self._write(buffer, capture_time, sequence, wall_time, targets)
+            except Exception:
+                logger.exception("Unable to record frame")
+            finally:
+                buffers.release(buffer)
+                self.queue.task_done()
+
+
+def read_segment(path: pathlib.Path) -> typing.Iterator[RecordedFrame]:
+    """
+    Reads the frames in one segment file, in the order they were written
+    """
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < SEGMENT_HEADER.size:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version = SEGMENT_HEADER.unpack_from(data, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise IOError(f"{path} is not a recording segment")
+
+            offset = SEGMENT_HEADER.size
+            while offset + RECORD_HEADER.size <= len(data):
+                magic, sequence, capture_time, wall_time, width, height, channels, encoding, payload_size, result_size = \
+                    RECORD_HEADER.unpack_from(data, offset)
+                # The rest of the segment was never written
+                if magic != RECORD_MAGIC:
+                    break
+                offset += RECORD_HEADER.size
+
+                # Frames are copied out, so none keeps the map open
+                shape = (height, width, channels) if channels > 1 else (height, width)
+                payload = numpy.frombuffer(data, numpy.uint8, payload_size, offset)
+                if encoding == ENCODING_JPEG:
+                    frame = cv2.imdecode(payload, cv2.IMREAD_UNCHANGED)
+                else:
+                    frame = payload.reshape(shape).copy()
+                del payload
+                offset += payload_size
+                targets = _decode_targets(data[offset:offset + result_size])
+                offset += result_size
+
+                yield RecordedFrame(frame, capture_time, sequence, wall_time, targets)
+
+
+def read_recording(directory: pathlib.Path) -> typing.Iterator[RecordedFrame]:
+    """
+    Reads every frame recorded in a directory, oldest first
+
+    :param directory: The directory a FrameRecorder wrote to
+    """
+
+    for path in list_segments(directory):
+        yield from read_segment(path)
+
+
+if __name__ == "__main__":
+    import sys
+
+    for recorded in read_recording(pathlib.Path(sys.argv[1])):
+        print(recorded.sequence, recorded.time, recorded.frame.shape, recorded.targets)
@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import threading
+import typing
+
+
+class ReorderBuffer:
+    """
+    Puts worker results back in capture order before they are published
+
+    Results are released in sequence order. A result waits at most max_hold
+    seconds for an older frame that is still being processed; after that it is
+    released anyway. Results older than the last released one are dropped and
+    counted, so the robot never sees a stale detection after a newer one.
+
+    :param max_hold: Seconds a result waits for older frames
+    :param on_drop: Called with each stale result that is dropped
+    """
+
+    def __init__(self, max_hold: float = 0.05, on_drop: typing.Optional[typing.Callable[[typing.Any], None]] = None):
+        self.max_hold = max_hold
+        self.on_drop = on_drop
+        self.last_published = -1
+        self.dropped = 0
+
+        self._pending: typing.List[typing.Tuple[int, int, float, typing.Any]] = []
+        self._skipped: typing.Set[int] = set()
+        # Tie breaker so the heap never has to compare two results
+        self._arrival = itertools.count()
+        self._lock = threading.Lock()
+
+    def push(self, sequence: int, result: typing.Any, now: float):
+        """
+        Adds a finished result
+
+        :param sequence: The sequence number of the frame the result is for
+        :param result: The result to publish
+        :param now: The current time.monotonic() value
+        """
+
+        with self._lock:
+            stale = sequence <= self.last_published
+            if stale:
+                self.dropped += 1
+            else:
+                heapq.heappush(self._pending, (sequence, next(self._arrival), now, result))
+        if stale and self.on_drop is not None:
+            self.on_drop(result)
+
+    def skip(self, sequence: int):
+        """
+        Marks a frame that will never produce a result, e.g. because it was
+        dropped from a queue, so newer results do not wait for it
+        """
+
+        with self._lock:
+            if sequence > self.last_published:
+                self._skipped.add(sequence)
+
+    def pop_ready(self, now: float) -> typing.List[typing.Any]:
+        """
+        Removes the results that can be published, oldest first
+
+        :param now: The current time.monotonic() value
+
+        :return: The results to publish, in capture order
+        """
+
+        ready = []
+        stale = []
+        with self._lock:
+            while len(self._pending) > 0:
+                while self.last_published + 1 in self._skipped:
+                    self._skipped.remove(self.last_published + 1)
+                    self.last_published += 1
+
+                sequence, _, arrived, result = self._pending[0]
+                if sequence <= self.last_published:
+                    heapq.heappop(self._pending)
+                    self.dropped += 1
+                    stale.append(result)
+                elif sequence == self.last_published + 1 or now - arrived >= self.max_hold:
+                    heapq.heappop(self._pending)
+                    self.last_published = sequence
+                    ready.append(result)
+                else:
+                    break
+
+            if len(self._skipped) > 0:
+                self._skipped = {sequence for sequence in self._skipped if sequence > self.last_published}
+        if self.on_drop is not None:
+            for result in stale:
+                self.on_drop(result)
+        return ready
+
+    def time_to_release(self, now: float) -> typing.Optional[float]:
+        """
+        :return: Seconds until the oldest held result is released anyway, or
+                    None if nothing is held
+        """
+
+        with self._lock:
+            if len(self._pending) == 0:
+                return None
+            return max(0.0, self._pending[0][2] + self.max_hold - now)
@@ -1,3 +1,6 @@
+import collections
+import threading
+import time
 import typing
 
 import networktables
@@ -8,18 +11,69 @@ class CircleDefinition:
     y: float
     radius: float
     anglex: float
+    area: float
+    score: float
 
-    def __init__(self, x: float, y: float, radius: float, anglex: float):
+    def __init__(self, x: float, y: float, radius: float, anglex: float, area: float=0, score: float=0):
         self.x = x
         self.y = y
         self.radius = radius
         self.anglex = anglex
+        self.area = area
+        self.score = score
+
+
+class ClockSync:
+    """
+    Estimates the offset from time.monotonic() to the robot's clock
+
+    The robot publishes its own clock (Timer.getFPGATimestamp()) in seconds.
+    An update always arrives some network delay after it was sent, which can
+    only make robot_time - now smaller, so the largest offset among the
+    recent samples is the best estimate.
+
+    :param sample_count: How many recent samples to keep
+    :param max_jump: Start over when a sample is this many seconds off the
+                        estimate, e.g. after the robot restarted
+    """
+
+    def __init__(self, sample_count: int=50, max_jump: float=1.0):
+        self.max_jump = max_jump
+        self.samples: typing.Deque[float] = collections.deque(maxlen=sample_count)
+        self.lock = threading.Lock()
+
+    def add_sample(self, robot_time: float, local_time: float):
+        offset = robot_time - local_time
+        with self.lock:
+            if len(self.samples) > 0 and abs(offset - max(self.samples)) > self.max_jump:
+                self.samples.clear()
+            self.samples.append(offset)
+
+    def get_offset(self) -> typing.Optional[float]:
+        with self.lock:
+            return max(self.samples) if len(self.samples) > 0 else None
+
+    def to_robot_time(self, local_time: float) -> typing.Optional[float]:
+        """
+        :param local_time: A time.monotonic() value
+
+        :return: The same moment on the robot's clock, or None before the
+                    robot has sent its clock
+        """
+
+        offset = self.get_offset()
+        return local_time + offset if offset is not None else None
 
 
 class RobotConnection:
     def __init__(self, robot_ip: str, fake: bool=False):
         self.robot_ip = robot_ip
         self.fake = fake
+        # Looking a table or an entry up goes through a lock and a string
+        # lookup in networktables, so keep the handles around
+        self.tables: typing.Dict[str, networktables.NetworkTable] = {}
+        self.entries: typing.Dict[typing.Tuple[str, str], typing.Any] = {}
+        self.clock = ClockSync()
 
     def connect(self):
         if self.fake:
@@ -27,11 +81,44 @@ class RobotConnection:
         else:
             networktables.NetworkTables.initialize(server=self.robot_ip)
 
+    def sync_clock(self, table_name: str, key: str="robot_time"):
+        """
+        Follows the robot's clock, published by the robot under key, so
+        capture times can be sent in robot time
+        """
+
+        def on_robot_time(source, key, value, is_new):
+            self.clock.add_sample(value, time.monotonic())
+
+        self.get_table(table_name).addEntryListener(on_robot_time, key=key)
+
     def get_table(self, table_name: str) -> networktables.NetworkTable:
-        return networktables.NetworkTables.getTable(table_name)
+        table = self.tables.get(table_name)
+        if table is None:
+            table = networktables.NetworkTables.getTable(table_name)
+            self.tables[table_name] = table
+        return table
+
+    def get_entry(self, table_name: str, key: str):
+        entry = self.entries.get((table_name, key))
+        if entry is None:
+            entry = self.get_table(table_name).getEntry(key)
+            self.entries[(table_name, key)] = entry
+        return entry
 
     def put_number(self, table_name: str, key: str, value: float):
-        self.get_table(table_name).putNumber(key, value)
+        self.get_entry(table_name, key).setDouble(value)
+
+    def put_number_array(self, table_name: str, key: str, values: typing.Sequence[float]):
+        self.get_entry(table_name, key).setDoubleArray(values)
+
+    def flush(self):
+        """
+        Sends everything put since the last update right away, as one update,
+        instead of waiting for the next periodic one
+        """
+
+        networktables.NetworkTables.flush()
 
     def put_circle(self, table_name: str, circle: typing.Optional[CircleDefinition]):
         if circle is None:
@@ -44,3 +131,32 @@ class RobotConnection:
             self.put_number(table_name, "centery", circle.y)
             self.put_number(table_name, "radius", circle.radius)
             self.put_number(table_name, "anglex", circle.anglex)
+
+    def put_latency(self, table_name: str, capture_time: float, latency: float):
+        """
+        Publishes when the frame behind the next targets was captured, so the
+        robot can make up for the time the pipeline took
+
+        :param capture_time: When the frame came off the camera, on the
+                                time.monotonic() clock
+        :param latency: Seconds from then to now
+        """
+
+        robot_time = self.clock.to_robot_time(capture_time)
+        self.put_number(table_name, "capture_time", robot_time if robot_time is not None else -1)
+        self.put_number(table_name, "latency", latency)
+
+    def put_targets(self, table_name: str, targets: typing.Sequence[CircleDefinition]):
+        """
+        Publishes every candidate ball as parallel arrays, index i of each
+        array is the same ball, and the first one also as the single circle
+        """
+
+        self.put_circle(table_name, targets[0] if len(targets) > 0 else None)
+        self.put_number_array(table_name, "targets_x", [target.x for target in targets])
+        self.put_number_array(table_name, "targets_y", [target.y for target in targets])
+        self.put_number_array(table_name, "targets_radius", [target.radius for target in targets])
+        self.put_number_array(table_name, "targets_anglex", [target.anglex for target in targets])
+        self.put_number_array(table_name, "targets_area", [target.area for target in targets])
+        self.put_number_array(table_name, "targets_score", [target.score for target in targets])
+        self.flush()
@@ -0,0 +1,174 @@
+import abc
+import collections
+import threading
+import typing
+
+
+class FrameScheduler(abc.ABC):
+    """
+    Hands items from one producer stage to the workers of the next
+
+    put never wakes more than the one waiter that can take the new item.
+    Items that are dropped to make room are passed to on_drop, so every
+    drop is accounted for.
+
+    :param on_drop: Called, outside the lock, with every item dropped
+    """
+
+    def __init__(self, on_drop: typing.Optional[typing.Callable[[typing.Any], None]]=None):
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def put(self, item: typing.Any):
+        pass
+
+    @abc.abstractmethod
+    def get(self, worker: int=0, timeout: typing.Optional[float]=None) -> typing.Any:
+        """
+        Waits for an item
+
+        :param worker: The index of the calling worker
+        :param timeout: Seconds to wait, None waits forever
+
+        :return: The item, or None if the timeout ran out
+        """
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def _dropped(self, items: typing.List[typing.Any]):
+        if self.on_drop is not None:
+            for item in items:
+                self.on_drop(item)
+
+
+class BoundedFifo(FrameScheduler):
+    """
+    Items in arrival order, at most capacity of them
+
+    :param capacity: Most items held at once
+    :param block: When full, make put wait for room instead of dropping the
+                    oldest item, pushing back on the producer
+    """
+
+    def __init__(self, capacity: int=4, block: bool=False, on_drop: typing.Optional[typing.Callable[[typing.Any], None]]=None):
+        super().__init__(on_drop)
+        self.capacity = capacity
+        self.block = block
+        self.items: typing.Deque[typing.Any] = collections.deque()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def put(self, item: typing.Any):
+        dropped = []
+        with self.lock:
+            if self.block:
+                self.not_full.wait_for(lambda: len(self.items) < self.capacity)
+            while len(self.items) >= self.capacity:
+                dropped.append(self.items.popleft())
+                self.dropped += 1
+            self.items.append(item)
+            self.not_empty.notify()
+        self._dropped(dropped)
+
+    def get(self, worker: int=0, timeout: typing.Optional[float]=None) -> typing.Any:
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            item = self.items.popleft()
+            self.not_full.notify()
+            return item
+
+    def get_all(self, timeout: typing.Optional[float]=None) -> typing.List[typing.Any]:
+        """
+        Waits for at least one item, then takes every item held
+
+        :return: The items, oldest first, empty if the timeout ran out
+        """
+
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: len(self.items) > 0, timeout):
+                return []
+            items = list(self.items)
+            self.items.clear()
+            self.not_full.notify_all()
+            return items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class LatestMailbox(BoundedFifo):
+    """
+    Holds only the newest item, a new one replaces the one waiting. Workers
+    always get the freshest frame, at the cost of dropping more of them.
+    """
+
+    def __init__(self, on_drop: typing.Optional[typing.Callable[[typing.Any], None]]=None):
+        super().__init__(capacity=1, block=False, on_drop=on_drop)
+
+
+class RoundRobin(FrameScheduler):
+    """
+    Deals items to the workers in turn, each from its own mailbox, so only
+    the worker the item is meant for wakes up. A new item for a worker that
+    has not taken its last one yet replaces it.
+
+    :param worker_count: Number of workers calling get
+    """
+
+    def __init__(self, worker_count: int, on_drop: typing.Optional[typing.Callable[[typing.Any], None]]=None):
+        super().__init__(on_drop)
+        self.mailboxes: typing.List[typing.Optional[typing.Any]] = [None] * worker_count
+        self.ready = [threading.Condition(self.lock) for _ in range(worker_count)]
+        self.next_worker = 0
+
+    def put(self, item: typing.Any):
+        dropped = []
+        with self.lock:
+            # Prefer the next worker in turn that is free, otherwise replace
+            # the item waiting for the next one in turn
+            worker = self.next_worker
+            for offset in range(len(self.mailboxes)):
+                candidate = (self.next_worker + offset) % len(self.mailboxes)
+                if self.mailboxes[candidate] is None:
+                    worker = candidate
+                    break
+            if self.mailboxes[worker] is not None:
+                dropped.append(self.mailboxes[worker])
+                self.dropped += 1
+            self.mailboxes[worker] = item
+            self.next_worker = (worker + 1) % len(self.mailboxes)
+            self.ready[worker].notify()
+        self._dropped(dropped)
+
+    def get(self, worker: int=0, timeout: typing.Optional[float]=None) -> typing.Any:
+        with self.lock:
+            if not self.ready[worker].wait_for(lambda: self.mailboxes[worker] is not None, timeout):
+                return None
+            item = self.mailboxes[worker]
+            self.mailboxes[worker] = None
+            return item
+
+    def __len__(self) -> int:
+        return sum(1 for item in self.mailboxes if item is not None)
+
+
+def create_scheduler(policy: str, worker_count: int, capacity: int=4,
+                        on_drop: typing.Optional[typing.Callable[[typing.Any], None]]=None) -> FrameScheduler:
+    """
+    :param policy: "latest", "fifo", "fifo_block" or "round_robin"
+    """
+
+    if policy == "latest":
+        return LatestMailbox(on_drop=on_drop)
+    if policy == "fifo":
+        return BoundedFifo(capacity, block=False, on_drop=on_drop)
+    if policy == "fifo_block":
+        return BoundedFifo(capacity, block=True, on_drop=on_drop)
+    if policy == "round_robin":
+        return RoundRobin(worker_count, on_drop=on_drop)
+    raise ValueError(f"Unknown scheduler policy {policy}")
@@ -1,48 +1,140 @@
 import io
 import json
+import time
 import typing
-import cv2
+import uuid
 import flask
 from flask_cors import CORS
 
 import app_contexts
+import metrics
+import mjpeg
 import shared_context
 
 
 app = flask.Flask(__name__, static_folder='./build/', static_url_path='/')
 CORS(app)
 
+http_requests = metrics.counter("http_requests_total", "Requests handled by the web server")
+http_latency = metrics.histogram("http_request_seconds", "Time spent handling web requests")
+# Versions start over when the server restarts, this keeps an old ETag from
+# matching a new frame
+server_id = uuid.uuid4().hex[:8]
+schema_json = json.dumps(app_contexts.APP_CONTEXT_SCHEMA)
+# Serialized configs by format, each with the snapshot version it is for
+config_json_cache: typing.Dict[str, typing.Tuple[int, str]] = {}
+stream = mjpeg.MjpegStream(shared_context.last_seen, lambda: shared_context.config.snapshot().stream_context)
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response: flask.Response):
+    http_requests.inc()
+    start_time = getattr(flask.g, "request_start_time", None)
+    if start_time is not None:
+        http_latency.observe(time.perf_counter() - start_time)
+    return response
+
 
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
 
 
+def get_config_json(app_context: app_contexts.AppContext, format: str="full") -> str:
+    """
+    Serializes a config snapshot once per version
+
+    :param format: "full" for values with their schema, "values" for just
+                    the values
+    """
+
+    cached = config_json_cache.get(format)
+    if cached is not None and cached[0] == app_context.version:
+        return cached[1]
+
+    json_dict = app_context.to_json()
+    if format == "values":
+        json_dict = app_contexts.split_app_context_json(json_dict)[0]
+    config_json = json.dumps(json_dict)
+    # Snapshots never change, so racing requests store the same thing
+    config_json_cache[format] = (app_context.version, config_json)
+    return config_json
+
+
 @app.route('/api/current-config' , methods = ['GET'])
 def get_config():
-    response = flask.make_response(json.dumps(shared_context.app_context.to_json()))
+    app_context = shared_context.config.snapshot()
+    format = flask.request.args.get('format', 'full')
+    if format not in ('full', 'values'):
+        flask.abort(400)
+
+    response = flask.make_response(get_config_json(app_context, format))
     response.headers['Content-Type'] = 'application/json'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    # Clients may keep it but have to check it is still current
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{server_id}-{app_context.version}-{format}")
     # response.headers['Access-Control-Allow-Origin'] = '*'
-    return response
+    return response.make_conditional(flask.request)
+
+
+@app.route('/api/config-schema' , methods = ['GET'])
+def get_config_schema():
+    response = flask.make_response(schema_json)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{server_id}-schema")
+    return response.make_conditional(flask.request)
 
 
 @app.route('/api/last-seen.jpg' , methods = ['GET'])
 def get_image():
     last_seen = shared_context.last_seen
 
-    frame, circle = last_seen.get_frame_and_circle()
+    # Encoded once per frame no matter how many clients poll
+    jpeg, version = last_seen.get_encoded(mjpeg.encode_jpeg)
+    response = flask.make_response(jpeg)
+    response.headers['Content-Type'] = 'image/jpeg'
+    # Browsers may keep the image but have to check it is still the newest
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{server_id}-{version}")
+    # response.headers['Access-Control-Allow-Origin'] = '*'
+    return response.make_conditional(flask.request)
 
-    frame = cv2.cvtColor(frame, cv2.COLOR_HSV2BGR)
-    if circle is not None:
-        x, y, radius = circle
-        cv2.circle(frame, (int(x), int(y)), int(radius), (0, 255, 0), 5)
 
-    _, buffer = cv2.imencode('.jpg', frame)
-    response = flask.make_response(buffer.tobytes())
-    response.headers['Content-Type'] = 'image/jpeg'
+@app.route('/api/stream.mjpg' , methods = ['GET'])
+def get_stream():
+    # Every viewer shares one encode per frame, see mjpeg.MjpegStream
+    response = flask.Response(stream.parts(), mimetype=mjpeg.CONTENT_TYPE)
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+
+@app.route('/api/metrics' , methods = ['GET'])
+def get_metrics():
+    # Prometheus asks for text/plain, browsers and the UI get JSON
+    accept = flask.request.headers.get('Accept', '')
+    prometheus = 'text/plain' in accept and 'text/html' not in accept and 'application/json' not in accept
+    if flask.request.args.get('format', 'prometheus' if prometheus else 'json') == 'prometheus':
+        response = flask.make_response(metrics.registry.to_prometheus())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    else:
+        response = flask.make_response(json.dumps(metrics.registry.to_json()))
+        response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+
+@app.route('/api/governor' , methods = ['GET'])
+def get_governor():
+    # The operating point the pipeline is running at and why
+    response = flask.make_response(json.dumps(shared_context.pipeline_governor.to_json()))
+    response.headers['Content-Type'] = 'application/json'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    # response.headers['Access-Control-Allow-Origin'] = '*'
     return response
 
 
@@ -57,12 +149,12 @@ def set_config():
     else:
         raise Exception(f'Unexpected type {type(json_dict)}')
 
-    for update in updates:
-        shared_context.app_context.update(update)
+    # Workers pick the new snapshot up on their next frame
+    app_context = shared_context.config.update(updates)
 
-    app_contexts.save_app_context(shared_context.config_file, shared_context.app_context)
+    shared_context.config_writer.save(app_context)
 
-    response = flask.make_response(json.dumps(shared_context.app_context.to_json()))
+    response = flask.make_response(get_config_json(app_context))
     response.headers['Content-Type'] = 'application/json'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     # response.headers['Access-Control-Allow-Origin'] = '*'
@@ -75,7 +167,8 @@ def static_proxy(path):
 
 
 def start_server():
-    app.run(host='0.0.0.0', port=5000)
+    # Each stream viewer holds a request thread for as long as it watches
+    app.run(host='0.0.0.0', port=5000, threaded=True)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import atexit
+import os
 import pathlib
 import threading
 import typing
@@ -5,6 +7,8 @@ import typing
 import numpy
 
 import app_contexts
+import config_store
+import governor
 
 class LastFrame:
     frame: numpy.ndarray
@@ -15,24 +19,120 @@ class LastFrame:
         self.frame = frame
         self.timestamp = timestamp
         self.circle = circle
+        # Bumped on every new frame
+        self.version = 0
         self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+        # The last frame encoded by get_encoded and its version
+        self.encoded: typing.Optional[bytes] = None
+        self.encoded_version = -1
+        self.encode_lock = threading.Lock()
 
     def get_frame_and_circle(self):
+        """
+        :return: A copy of the frame, the pipeline reuses its buffer once it
+                    is replaced, and the circle found in it
+        """
+
         with self.lock:
-            return self.frame, self.circle
+            return self.frame.copy(), self.circle
+
+    def get_encoded(self, encode: typing.Callable[[numpy.ndarray, typing.Any], bytes]) -> typing.Tuple[bytes, int]:
+        """
+        Encodes the frame at most once per version, concurrent callers for
+        the same version wait for the one encode
+
+        :param encode: Turns a copy of the frame and its circle into bytes
+
+        :return: The encoded frame and its version
+        """
+
+        with self.encode_lock:
+            with self.lock:
+                if self.encoded is not None and self.encoded_version == self.version:
+                    return self.encoded, self.encoded_version
+                frame, circle, version = self.frame.copy(), self.circle, self.version
+            self.encoded = encode(frame, circle)
+            self.encoded_version = version
+            return self.encoded, version
+
+    def wait_for_frame(self, version: int, timeout: typing.Optional[float]=None):
+        """
+        Waits for a frame newer than version
+
+        :return: A copy of the frame, its circle and its version, or None
+                    for all three if the timeout ran out first
+        """
+
+        with self.changed:
+            if not self.changed.wait_for(lambda: self.version != version, timeout):
+                return None, None, None
+            return self.frame.copy(), self.circle, self.version
+
+    def set_frame_and_circle(self, frame: numpy.ndarray, circle: typing.Optional[numpy.ndarray]) -> numpy.ndarray:
+        """
+        :return: The frame that was replaced
+        """
 
-    def set_frame_and_circle(self, frame: numpy.ndarray, circle: typing.Optional[numpy.ndarray]):
         with self.lock:
+            previous = self.frame
             self.frame = frame
             self.circle = circle
+            self.version += 1
+            self.changed.notify_all()
+        return previous
 
 
 config_file = pathlib.Path("ballfinder.json")
 if not config_file.exists():
     app_contexts.save_app_context(config_file, app_contexts.get_default_app_context())
-app_context = app_contexts.load_app_context(config_file)
-resolution = (320, 240)
+# Read config.snapshot() once per frame or request, never keep it around
+config = config_store.ConfigStore(app_contexts.load_app_context(config_file))
+# Saves config changes off the request threads
+config_writer = config_store.ConfigWriter(config_file)
+atexit.register(config_writer.flush)
+# "thread" runs detection in worker threads, "process" in a process pool
+detection_backend = os.environ.get("BALLFINDER_BACKEND", "thread")
+# Camera resolutions the governor may pick from, smallest first, e.g.
+# "320x240,640x480". The process backend's shared frames have a fixed size,
+# so it only ever uses the first one.
+resolutions = governor.parse_resolutions(os.environ.get("BALLFINDER_RESOLUTIONS", "320x240"))
+if detection_backend == "process":
+    resolutions = resolutions[:1]
+resolution = resolutions[0]
+framerate = float(os.environ.get("BALLFINDER_FRAMERATE", "30"))
+# Steps the resolution and the share of frames processed to hold the target
+# capture to publish latency, see governor.Governor. Starts out processing
+# every frame at the smallest resolution.
+max_frame_skip = max(1, int(os.environ.get("BALLFINDER_MAX_FRAME_SKIP", "3")))
+governor_ladder = governor.build_ladder(resolutions, framerate, max_frame_skip)
+pipeline_governor = governor.Governor(
+    governor_ladder,
+    start=governor_ladder.index(governor.OperatingPoint(resolution, framerate, 1)),
+    target_latency=float(os.environ.get("BALLFINDER_TARGET_LATENCY", "0.1")),
+    enabled=os.environ.get("BALLFINDER_GOVERNOR", "1") != "0",
+)
+# Number of detection workers, 0 for one per core but one
+worker_count = int(os.environ.get("BALLFINDER_WORKERS", "0"))
+# How frames reach the worker threads: "fifo" queues up to queue_depth frames
+# and drops the oldest when full, "fifo_block" makes capture wait instead of
+# dropping, "latest" keeps only the newest frame and "round_robin" deals
+# frames to the workers in turn
+scheduler_policy = os.environ.get("BALLFINDER_SCHEDULER", "fifo")
+queue_depth = int(os.environ.get("BALLFINDER_QUEUE_DEPTH", "4"))
+# "picamera", "synthetic", a video file, an image directory, a directory of
+# recorder segments or a .npz recording
+frame_source = os.environ.get("BALLFINDER_SOURCE", "picamera")
+# Directory to record published frames and their targets to, see
+# recorder.FrameRecorder. Empty to not record.
+record_directory = os.environ.get("BALLFINDER_RECORD", "")
+record_segment_mb = int(os.environ.get("BALLFINDER_RECORD_SEGMENT_MB", "64"))
+record_max_mb = int(os.environ.get("BALLFINDER_RECORD_MAX_MB", "512"))
+# "raw" or "jpeg"
+record_encoding = os.environ.get("BALLFINDER_RECORD_ENCODING", "raw")
 last_seen = LastFrame(numpy.zeros((
         resolution[1],
         resolution[0],
-    )), 0, None)
+        3,
+    ), numpy.uint8), 0, None)
@@ -0,0 +1,99 @@
+import threading
+import typing
+
+
+class Window(typing.NamedTuple):
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+
+class BallTracker:
+    """
+    Predicts where the ball will be with a constant velocity model
+
+    Several workers share one tracker and may finish frames out of order, so
+    every call takes the frame's capture time and updates from frames older
+    than the newest detection are ignored.
+
+    :param padding: Pixels added around the ball's predicted extent
+    :param max_age: Seconds after the last detection before the track is lost
+    :param smoothing: Weight of the newest velocity measurement, 0 to 1
+    """
+
+    def __init__(self, padding: float=24, max_age: float=0.5, smoothing: float=0.5):
+        self.padding = padding
+        self.max_age = max_age
+        self.smoothing = smoothing
+
+        self.time: typing.Optional[float] = None
+        self.x = 0.0
+        self.y = 0.0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.size = 0.0
+        self.lock = threading.Lock()
+
+    def predict(self, timestamp: float, frame_shape: typing.Tuple[int, ...]) -> typing.Optional[Window]:
+        """
+        :param timestamp: The capture time of the frame about to be searched
+        :param frame_shape: The shape of that frame
+
+        :return: The region to search first, or None to search the whole frame
+        """
+
+        with self.lock:
+            if self.time is None or abs(timestamp - self.time) > self.max_age:
+                return None
+            dt = timestamp - self.time
+            x = self.x + self.vx * dt
+            y = self.y + self.vy * dt
+            # Grow the window with the distance travelled, the prediction gets
+            # less certain the further the ball moves
+            half = self.size / 2 + self.padding + (abs(self.vx) + abs(self.vy)) * abs(dt) / 2
+
+        height, width = frame_shape[0], frame_shape[1]
+        window = Window(
+            max(int(x - half), 0),
+            max(int(y - half), 0),
+            min(int(x + half) + 1, width),
+            min(int(y + half) + 1, height),
+        )
+        if window.x0 >= window.x1 or window.y0 >= window.y1:
+            return None
+        return window
+
+    def update(self, timestamp: float, x: float, y: float, size: float):
+        """
+        Records a detection
+
+        :param timestamp: The capture time of the frame the ball was found in
+        :param x: The ball's center x
+        :param y: The ball's center y
+        :param size: The ball's extent in pixels
+        """
+
+        with self.lock:
+            if self.time is not None and timestamp <= self.time:
+                return
+            if self.time is None or timestamp - self.time > self.max_age:
+                self.vx = 0.0
+                self.vy = 0.0
+            else:
+                dt = timestamp - self.time
+                self.vx += self.smoothing * ((x - self.x) / dt - self.vx)
+                self.vy += self.smoothing * ((y - self.y) / dt - self.vy)
+            self.time = timestamp
+            self.x = x
+            self.y = y
+            self.size = size
+
+    def lose(self, timestamp: float):
+        """
+        Drops the track after a frame where the ball was not found anywhere
+        """
+
+        with self.lock:
+            if self.time is not None and timestamp > self.time:
+                self.time = None
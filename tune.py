@@ -0,0 +1,306 @@
+import argparse
+import collections
+import concurrent.futures
+import copy
+import itertools
+import json
+import math
+import os
+import pathlib
+import random
+import time
+import typing
+
+import cv2
+import numpy
+
+import app_contexts
+import color_filter
+import evaluate
+import image_finder
+import logger
+
+
+# The AppContextUpdates that make one variant of the base config
+Variant = typing.List[app_contexts.AppContextUpdate]
+DETECTORS = ("find_image", "find_circle_in_image")
+
+
+class StageCache:
+    """
+    Results of one pipeline stage, keyed by the frame and the parameters the
+    stage depends on
+
+    Each result is stored with the time it took to compute, so a variant that
+    reuses it is still charged what the stage would cost it on its own.
+    """
+
+    def __init__(self):
+        self.entries: typing.Dict[typing.Hashable, typing.Tuple[typing.Any, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable, compute: typing.Callable[[], typing.Any]) -> typing.Tuple[typing.Any, float]:
+        """
+        :return: The result and the seconds it took to compute
+        """
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        start_time = time.perf_counter()
+        value = compute()
+        entry = (value, time.perf_counter() - start_time)
+        self.entries[key] = entry
+        return entry
+
+
+def get_mask_key(app_context: app_contexts.AppContext) -> typing.Hashable:
+    """
+    :return: Everything the cleaned up color mask depends on. Color ranges
+                that compile to the same filter share a key.
+    """
+
+    hsv_filter = color_filter.get_color_filter(app_context.color_context)
+    boxes = tuple((tuple(lower), tuple(upper)) for lower, upper in hsv_filter.boxes)
+    return (app_context.pipeline_context.color_space.name, hsv_filter.conversion, boxes)
+
+
+def get_edges_key(app_context: app_contexts.AppContext) -> typing.Hashable:
+    return (get_mask_key(app_context), image_finder.CANNY_THRESHOLDS)
+
+
+def get_hough_key(app_context: app_contexts.AppContext) -> typing.Hashable:
+    circle_context = app_context.circle_context
+    return (get_edges_key(app_context), circle_context.dp, circle_context.param1, circle_context.param2,
+            app_context.pipeline_context.hough_roi)
+
+
+def apply_variant(base: app_contexts.AppContext, variant: Variant) -> app_contexts.AppContext:
+    app_context = copy.deepcopy(base)
+    for update in variant:
+        app_context.update(update)
+    return app_context
+
+
+def run_variant(dataset: typing.Sequence[evaluate.LabeledFrame], app_context: app_contexts.AppContext, detector: str,
+                    caches: typing.Dict[str, StageCache], tolerance: float) -> dict:
+    """
+    Scores one variant, reusing the stages earlier variants already ran
+
+    find_image is scored on the full frame search, without tracking or the
+    coarse to fine search, so every frame stands on its own.
+
+    :return: The accuracy and the per-frame cost of the variant
+    """
+
+    mask_key = get_mask_key(app_context)
+    edges_key = get_edges_key(app_context)
+    hough_key = get_hough_key(app_context)
+    score = evaluate.Score(tolerance)
+    frame_costs = []
+    for index, labeled in enumerate(dataset):
+        # The mask lives in a scratch buffer the next frame overwrites
+        mask, cost = caches["mask"].get((index, mask_key), lambda: image_finder.get_blob_mask(labeled.frame, app_context).copy())
+        if detector == "find_image":
+            targets, elapsed = caches["targets"].get((index, mask_key), lambda: image_finder.find_targets_in_mask(mask))
+            cost += elapsed
+            found = [(target.x, target.y, target.radius) for target in targets]
+        else:
+            edges, elapsed = caches["edges"].get((index, edges_key), lambda: cv2.Canny(mask, *image_finder.CANNY_THRESHOLDS))
+            cost += elapsed
+            circles, elapsed = caches["hough"].get((index, hough_key), lambda: image_finder.find_hough_circles(edges, mask, app_context))
+            cost += elapsed
+            start_time = time.perf_counter()
+            circle = image_finder.pick_circle(edges, circles, app_context)
+            cost += time.perf_counter() - start_time
+            found = [] if circle is None else [(float(circle[0]), float(circle[1]), float(circle[2]))]
+        score.add(found, labeled.balls)
+        frame_costs.append(cost)
+
+    return dict(score.to_json(), frame_cost_ms=float(numpy.mean(frame_costs)) * 1000 if frame_costs else 0.0)
+
+
+# Per worker process state, set up by _init_worker
+_worker_state: typing.Optional[typing.Tuple[typing.Sequence[evaluate.LabeledFrame], app_contexts.AppContext, str, float]] = None
+
+
+def _init_worker(dataset: typing.Sequence[evaluate.LabeledFrame], base: app_contexts.AppContext, detector: str, tolerance: float):
+    global _worker_state
+    _worker_state = (dataset, base, detector, tolerance)
+
+
+def _run_chunk(chunk: typing.Sequence[typing.Tuple[int, Variant]]) -> typing.Tuple[typing.List[dict], typing.Dict[str, typing.Tuple[int, int]]]:
+    assert _worker_state is not None
+    dataset, base, detector, tolerance = _worker_state
+    # The chunk's variants share their color ranges, so the masks are
+    # computed once per frame and freed with the chunk
+    caches = collections.defaultdict(StageCache)
+    results = []
+    for index, variant in chunk:
+        result = run_variant(dataset, apply_variant(base, variant), detector, caches, tolerance)
+        result["variant"] = index
+        results.append(result)
+    return results, {stage: (cache.hits, cache.misses) for stage, cache in caches.items()}
+
+
+def parse_value(text: str) -> typing.Any:
+    for parse in (int, float):
+        try:
+            return parse(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_param(text: str) -> typing.Tuple[str, typing.List[typing.Any]]:
+    """
+    Parses a swept parameter, a config key with a list of values or a range:
+
+        circle_context.param2=10,13,16
+        color_context.red1.lower.s=60:140:20
+
+    Ranges include their end.
+    """
+
+    key, separator, values = text.partition("=")
+    if not separator or not values:
+        raise ValueError(f"Expected key=values, got {text}")
+    if ":" in values:
+        start, stop, step = (parse_value(value) for value in values.split(":"))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return key, [start + step * i for i in range(count)]
+    return key, [parse_value(value) for value in values.split(",")]
+
+
+def build_variants(params: typing.Sequence[typing.Tuple[str, typing.List[typing.Any]]], samples: int=0, seed: int=0) -> typing.List[Variant]:
+    """
+    :param params: The swept keys with their values
+    :param samples: Pick this many random combinations instead of the whole
+                        grid, 0 for the whole grid
+
+    :return: The variants, each a list of updates to the base config
+    """
+
+    keys = [key for key, _ in params]
+    if samples <= 0:
+        combinations = list(itertools.product(*(values for _, values in params)))
+    else:
+        rng = random.Random(seed)
+        grid_size = math.prod(len(values) for _, values in params)
+        picked = set()
+        while len(picked) < min(samples, grid_size):
+            picked.add(tuple(rng.choice(values) for _, values in params))
+        combinations = sorted(picked)
+    return [[app_contexts.AppContextUpdate(key, value) for key, value in zip(keys, combination)] for combination in combinations]
+
+
+def sweep(dataset: typing.Sequence[evaluate.LabeledFrame], base: app_contexts.AppContext, variants: typing.Sequence[Variant],
+            detector: str="find_circle_in_image", tolerance: float=0.5, workers: int=0) -> typing.Tuple[typing.List[dict], dict]:
+    """
+    Scores every variant of the base config in a process pool
+
+    Variants are grouped by the mask they need, so each group's masks and
+    edges are computed once per frame, then split into chunks to keep every
+    worker busy.
+
+    :param workers: Worker processes, 0 for one per core
+
+    :return: The results, best first, and how often each stage cache hit
+    """
+
+    workers = workers or os.cpu_count() or 1
+    groups: typing.Dict[typing.Hashable, typing.List[typing.Tuple[int, Variant]]] = collections.defaultdict(list)
+    for index, variant in enumerate(variants):
+        groups[get_mask_key(apply_variant(base, variant))].append((index, variant))
+    chunk_size = max(1, math.ceil(len(variants) / workers))
+    chunks = [group[start:start + chunk_size] for group in groups.values() for start in range(0, len(group), chunk_size)]
+
+    results = []
+    cache_stats: typing.Dict[str, typing.List[int]] = collections.defaultdict(lambda: [0, 0])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(dataset, base, detector, tolerance)) as executor:
+        for chunk_results, chunk_stats in executor.map(_run_chunk, chunks):
+            results.extend(chunk_results)
+            for stage, (hits, misses) in chunk_stats.items():
+                cache_stats[stage][0] += hits
+                cache_stats[stage][1] += misses
+
+    for result in results:
+        result["updates"] = {update.key: update.value for update in variants[result["variant"]]}
+    results.sort(key=lambda result: (-round(result["f1"], 3), result["frame_cost_ms"]))
+    return results, {stage: {"hits": hits, "misses": misses} for stage, (hits, misses) in cache_stats.items()}
+
+
+def print_results(results: typing.Sequence[dict], count: int):
+    print(f"{'rank':<6}{'f1':>7}{'precision':>10}{'recall':>8}{'center px':>10}{'ms/frame':>10}  updates")
+    for rank, result in enumerate(results[:count], 1):
+        updates = " ".join(f"{key}={value}" for key, value in result["updates"].items())
+        print(f"{rank:<6}{result['f1']:>7.3f}{result['precision']:>10.3f}{result['recall']:>8.3f}"
+                f"{result['center_error_px']['mean']:>10.2f}{result['frame_cost_ms']:>10.2f}  {updates}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep config parameters over labeled frames and keep the best config")
+    parser.add_argument("--dataset", default="synthetic", help=f"synthetic, or a directory of images with a {evaluate.LABELS_FILE}")
+    parser.add_argument("--frames", type=int, default=100, help="Number of synthetic frames")
+    parser.add_argument("--balls", type=int, default=1, help="Synthetic balls of each color")
+    parser.add_argument("--resolution", type=int, nargs=2, default=(320, 240), metavar=("WIDTH", "HEIGHT"),
+                        help="Resolution of synthetic frames")
+    parser.add_argument("--config", type=pathlib.Path, default=pathlib.Path("ballfinder.json"), help="The config to vary")
+    parser.add_argument("--detector", default="find_circle_in_image", choices=DETECTORS)
+    parser.add_argument("--param", action="append", required=True, metavar="KEY=VALUES",
+                        help="A config key to sweep, e.g. circle_context.param2=10,13,16 or color_context.blue.lower.s=60:140:20")
+    parser.add_argument("--random", type=int, default=0, help="Try this many random combinations instead of the whole grid")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes, 0 for one per core")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Largest center error that counts as a hit, as a fraction of the ball's radius")
+    parser.add_argument("--top", type=int, default=10, help="Number of configs to print")
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("ballfinder.tuned.json"),
+                        help="Where to save the best config, ready to use as ballfinder.json")
+    parser.add_argument("--report", type=pathlib.Path, help="Write every result to this JSON file")
+    args = parser.parse_args()
+
+    logger.setLevel(logger.INFO)
+
+    base = app_contexts.load_app_context(args.config)
+    if args.dataset == "synthetic":
+        dataset = evaluate.load_synthetic(args.frames, tuple(args.resolution), base.color_context.team, args.balls)
+    else:
+        dataset = evaluate.load_labeled_directory(pathlib.Path(args.dataset))
+    if len(dataset) == 0:
+        raise ValueError(f"No frames in {args.dataset}")
+
+    params = [parse_param(param) for param in args.param]
+    variants = build_variants(params, args.random, args.seed)
+    # Catch bad keys before starting the pool
+    apply_variant(base, variants[0])
+    logger.info("Trying %d configs on %d frames", len(variants), len(dataset))
+
+    start_time = time.perf_counter()
+    results, cache_stats = sweep(dataset, base, variants, args.detector, args.tolerance, args.workers)
+    logger.info("Swept in %.1fs, stage cache %s", time.perf_counter() - start_time, cache_stats)
+    print_results(results, args.top)
+
+    best = apply_variant(base, variants[results[0]["variant"]])
+    app_contexts.save_app_context(args.output, best)
+    print(f"Saved the best config to {args.output}")
+
+    if args.report:
+        report = {
+            "dataset": args.dataset,
+            "frames": len(dataset),
+            "detector": args.detector,
+            "tolerance": args.tolerance,
+            "cache": cache_stats,
+            "results": results,
+        }
+        with args.report.open("w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
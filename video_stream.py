@@ -1,12 +1,12 @@
 import collections
 import contextlib
+import itertools
+import queue
 import threading
 import time
 import typing
 
 import numpy
-from picamera.array import PiRGBArray
-from picamera import PiCamera
 
 import logger
 
@@ -48,7 +48,13 @@ import logger
 
 class TimedFrame(typing.NamedTuple):
     frame: numpy.ndarray
+    # When the frame was handed to the pipeline, on the time.monotonic()
+    # clock. Still-port captures carry no sensor timestamp, so this is as
+    # close to capture as the Pi camera gets.
     time: float
+    # Increases by one for every captured frame, so results can be put back
+    # in capture order after the workers are done with them
+    sequence: int = 0
 
 
 def get_images(resolution=(320, 240), framerate=30):
@@ -61,7 +67,12 @@ def get_images(resolution=(320, 240), framerate=30):
     :return: The images
     """
 
+    # Imported here so the rest of the pipeline can run without a Pi camera
+    from picamera.array import PiRGBArray
+    from picamera import PiCamera
+
     image_lock = threading.Lock()
+    sequence = itertools.count()
 
     # Initialize the camera and grab a reference to the raw camera capture
     with contextlib.closing(PiCamera()) as camera:
@@ -73,7 +84,7 @@ def get_images(resolution=(320, 240), framerate=30):
             try:
                 for frame in camera.capture_continuous(raw_capture, format="bgr", use_video_port=True): # type: ignore
                     with image_lock:
-                        timestamp = time.time()
+                        timestamp = time.monotonic()
                         frame: PiRGBArray
                         # Grab the raw NumPy array representing the image
                         image = frame.array
@@ -82,11 +93,77 @@ def get_images(resolution=(320, 240), framerate=30):
                         raw_capture.truncate(0)
 
                         # Yield the image
-                        yield TimedFrame(image, timestamp)
-            except:
+                        yield TimedFrame(image, timestamp, next(sequence))
+            except Exception:
                 logger.exception("Failed to read image")
 
 
+def get_pooled_images(resolution=(320, 240), framerate=30, frame_pool=None):
+    """
+    Gets images from the picamera, captured straight into buffers from a
+    frame_pool.FramePool so no array is allocated per frame
+
+    The camera pads frames to a multiple of 32x16 pixels, other resolutions
+    are captured with get_images and copied into the pool's buffers.
+
+    :param resolution: The resolution of the images
+    :param framerate: The framerate of the images
+    :param frame_pool: The pool to take buffers from
+
+    :return: The images
+    """
+
+    if resolution[0] % 32 != 0 or resolution[1] % 16 != 0:
+        for image in get_images(resolution, framerate):
+            buffer = frame_pool.acquire(image.frame.shape)
+            numpy.copyto(buffer, image.frame)
+            yield TimedFrame(buffer, image.time, image.sequence)
+        return
+
+    from picamera import PiCamera
+
+    sequence = itertools.count()
+    stop = threading.Event()
+    captured = queue.Queue()
+
+    def outputs():
+        # The camera asks for the next buffer once the previous one is full
+        previous = None
+        while not stop.is_set():
+            buffer = frame_pool.acquire()
+            if previous is not None:
+                captured.put(TimedFrame(previous, time.monotonic(), next(sequence)))
+            previous = buffer
+            yield buffer
+        frame_pool.release(previous)
+
+    def capture():
+        try:
+            with contextlib.closing(PiCamera()) as camera:
+                camera.resolution = resolution
+                camera.framerate = framerate
+                camera.capture_sequence(outputs(), format="bgr", use_video_port=True)
+        except:
+            logger.exception("Failed to read image")
+        finally:
+            captured.put(None)
+
+    capture_thread = threading.Thread(target=capture)
+    capture_thread.daemon = True
+    capture_thread.start()
+
+    try:
+        while True:
+            image = captured.get()
+            if image is None:
+                break
+            yield image
+    finally:
+        stop.set()
+        # The camera has to be closed before it can be opened again
+        capture_thread.join(timeout=1.0)
+
+
 def transform_images(images: typing.Iterable[TimedFrame], transform: typing.Optional[typing.Callable[[numpy.ndarray], numpy.ndarray]]=None):
     """
     Transforms images from the picamera
@@ -105,7 +182,8 @@ def transform_images(images: typing.Iterable[TimedFrame], transform: typing.Opti
 
         yield TimedFrame(
             transformed_frame,
-            image.time
+            image.time,
+            image.sequence,
         )
 
 